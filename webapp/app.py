@@ -1,15 +1,35 @@
 import os
 import uuid
 import shutil
-from flask import Flask, render_template, request, redirect, url_for, abort, session, send_file
+from flask import Flask, render_template, request, redirect, url_for, abort, session, send_file, send_from_directory, Response, Request
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import sqlite3
 import json
 import subprocess
+import threading
+import time
+import csv
+import io
+import zlib
+import gzip
+import re
+import mimetypes
+import click
+import fcntl
+import hashlib
+import urllib.parse
+import multiprocessing
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+import numpy as np
 
 
 # AI - bit - downloads shit loads of models
@@ -32,16 +52,22 @@ APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 def rel_path(*parts: str) -> str:
     return os.path.join(APP_ROOT, *parts)
 
-HISTORY_DB = rel_path("History")     # or rel_path("history.db") if you prefer an extension
-USERS_DB   = rel_path("users.db")
-GAMES_DB   = rel_path("games.db")
+# Env overrides let tests/benchmarks point the app at scratch databases
+HISTORY_DB = os.environ.get("HISTORY_DB_PATH") or rel_path("History")     # or rel_path("history.db") if you prefer an extension
+USERS_DB   = os.environ.get("USERS_DB_PATH")   or rel_path("users.db")
+GAMES_DB   = os.environ.get("GAMES_DB_PATH")   or rel_path("games.db")
+
+# History is read through mmap; size the map to cover the whole snapshot
+HISTORY_MMAP_BYTES = int(os.environ.get("HISTORY_MMAP_BYTES", str(512 * 1024 * 1024)))
+HISTORY_CACHE_KIB  = int(os.environ.get("HISTORY_CACHE_KIB", str(64 * 1024)))
 
 
 from datetime import datetime
-app.jinja_env.globals['cache_bust'] = lambda: int(datetime.utcnow().timestamp())
 
-UPLOAD_FOLDER = os.path.join('static', 'images', 'gallery1')
-TRASH_FOLDER = os.path.join('private_trash')
+# Resolved against the app folder so the gallery manifest and uploads don't
+# depend on the cwd the server was started from
+UPLOAD_FOLDER = os.path.join(app.root_path, 'static', 'images', 'gallery1')
+TRASH_FOLDER = os.path.join(app.root_path, 'private_trash')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 
@@ -51,8 +77,105 @@ load_dotenv()
 
 app.secret_key = os.environ.get("FLASK_SECRET_KEY") or os.urandom(32)
 
+# ------------------
+# Password hashing
+# ------------------
+# scrypt/PBKDF2 hold the GIL for the whole hash, so every other request in the
+# worker stalls behind a login. Hashes run in a small process pool instead;
+# the request thread just waits on the future.
+#
+# The pool uses the spawn start method, which re-runs the main script as
+# __mp_main__ in every worker. Under `python app.py` that is this file; the
+# workers only need werkzeug's hash functions, so the startup work further
+# down (migrations, rank index, static asset scan) is skipped in them.
+HASH_WORKER = __name__ == '__mp_main__'
+
+class PasswordHasherBusy(Exception):
+    """More hashes in flight than PASSWORD_HASH_QUEUE allows, or one outlasted PASSWORD_HASH_TIMEOUT."""
+
+
+class PasswordHasher:
+    """
+    generate/check_password_hash on a bounded ProcessPoolExecutor.
+
+    At most `max_pending` hashes may be queued or running; past that, hash()
+    and verify() raise PasswordHasherBusy straight away so a burst of login
+    attempts can't pile up behind the pool. `method` is the Werkzeug method
+    string for new hashes (e.g. "scrypt:32768:8:1", "pbkdf2:sha256:600000");
+    needs_rehash() tells which stored hashes were made with other parameters.
+    workers=0 hashes inline in the calling thread.
+    """
+
+    def __init__(self, method='scrypt', workers=2, max_pending=8, timeout=10.0):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def _executor_for_pid(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # spawn: forking a threaded server process is not safe
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            try:
+                future = self._executor_for_pid().submit(fn, *args)
+            except BrokenProcessPool:
+                with self._lock:
+                    self._executor = None  # a worker died; start a fresh pool
+                future = self._executor_for_pid().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot frees when the hash finishes, even if we stop waiting on it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()  # only takes effect if it hasn't started yet
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        if self._prefix is None:
+            # "scrypt" expands to "scrypt:32768:8:1" etc.; learn the full form once
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+PASSWORD_HASHER = PasswordHasher(
+    method=os.environ.get("PASSWORD_HASH_METHOD", "scrypt"),
+    workers=int(os.environ.get("PASSWORD_HASH_WORKERS", "2")),
+    max_pending=int(os.environ.get("PASSWORD_HASH_QUEUE", "8")),
+    timeout=float(os.environ.get("PASSWORD_HASH_TIMEOUT", "10")),
+)
+atexit.register(PASSWORD_HASHER.shutdown)
+
+
 # Read PIN from environment variable and hash it
-SECRET_PIN_HASH = generate_password_hash(os.environ.get("APP_PIN", "default"))
+SECRET_PIN_HASH = None if HASH_WORKER else generate_password_hash(os.environ.get("APP_PIN", "default"), PASSWORD_HASHER.method)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -77,17 +200,616 @@ def login_required(f):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+# ------------------
+# Gallery manifest
+# ------------------
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # dimensions and variants are optional
+    Image = None
+
+GALLERY_MANIFEST = os.environ.get("GALLERY_MANIFEST_PATH") or rel_path("gallery_manifest.json")
+GALLERY_PAGE_SIZE = 24
+
+
+class GalleryManifest:
+    """
+    In-memory list of the gallery images (name, size, mtime, width, height,
+    sha256), kept in name order and persisted as JSON next to the app.
+
+    load() reconciles the manifest with the folder once, on first use; after
+    that upload()/delete() call add()/remove() and nothing lists the folder
+    again.
+    Every worker holds its own copy: changes are written under an flock on
+    `<manifest>.lock` after re-reading the file, and readers re-read it when
+    its mtime moves, so one worker's upload shows up in the others.
+    """
+
+    def __init__(self, folder, path):
+        self.folder = folder
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._names = []
+        self._by_hash = {}
+        self._file_version = None
+        self._loaded = False
+
+    def _describe(self, name, st, sha256=None):
+        file_path = os.path.join(self.folder, name)
+        if sha256 is None:
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            sha256 = digest.hexdigest()
+        width = height = None
+        if Image is not None:
+            try:
+                with Image.open(file_path) as im:
+                    width, height = im.size
+            except Exception:
+                pass
+        return {'name': name, 'size': st.st_size, 'mtime': int(st.st_mtime),
+                'width': width, 'height': height, 'sha256': sha256}
+
+    def _set(self, entries):
+        self._entries = entries
+        self._names = sorted(entries)
+        self._by_hash = {e['sha256']: e for e in entries.values()}
+
+    def _read_file(self):
+        try:
+            st = os.stat(self.path)
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self._set({e['name']: e for e in data.get('images', [])})
+            self._file_version = (st.st_mtime_ns, st.st_size)
+            return True
+        except (OSError, ValueError, KeyError, AttributeError):
+            return False
+
+    def _write_file(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'images': [self._entries[n] for n in self._names]}, f)
+        os.replace(tmp, self.path)
+        st = os.stat(self.path)
+        self._file_version = (st.st_mtime_ns, st.st_size)
+
+    @contextmanager
+    def _locked_update(self):
+        # Serialize writers across workers and start from the latest file
+        with self._lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._read_file()
+                yield
+                self._write_file()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self):
+        """Reuse manifest entries whose size/mtime still match the folder, describe the rest."""
+        with self._locked_update():
+            entries = {}
+            for name in os.listdir(self.folder):
+                if not allowed_file(name):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.folder, name))
+                    known = self._entries.get(name)
+                    if known and known['size'] == st.st_size and known['mtime'] == int(st.st_mtime):
+                        entries[name] = known
+                    else:
+                        entries[name] = self._describe(name, st)
+                except OSError as e:
+                    log_json("gallery_describe_failed", name=name, message=str(e))
+            self._set(entries)
+        self._loaded = True
+
+    def add(self, name, sha256=None):
+        """
+        Record a file already in the folder. If an image with the same content
+        is already listed, that entry is returned instead and nothing is added.
+        """
+        self._refresh()
+        st = os.stat(os.path.join(self.folder, name))
+        entry = self._describe(name, st, sha256)
+        with self._locked_update():
+            existing = self._by_hash.get(entry['sha256'])
+            if existing is not None and existing['name'] != name:
+                return existing
+            self._entries[name] = entry
+            self._by_hash[entry['sha256']] = entry
+            if name not in self._names:
+                bisect.insort(self._names, name)
+        return entry
+
+    def find_by_hash(self, sha256):
+        self._refresh()
+        return self._by_hash.get(sha256)
+
+    def remove(self, name):
+        """Drop an image; returns its last entry (or None)."""
+        self._refresh()
+        with self._locked_update():
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self._names.remove(name)
+                self._by_hash.pop(entry['sha256'], None)
+        return entry
+
+    def set_variants(self, name, variants):
+        self._refresh()
+        with self._locked_update():
+            if name in self._entries:
+                self._entries[name] = dict(self._entries[name], variants=variants)
+
+    def _refresh(self):
+        if not self._loaded:
+            self.load()
+            return
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        if (st.st_mtime_ns, st.st_size) != self._file_version:
+            with self._lock:
+                self._read_file()
+
+    def names(self):
+        self._refresh()
+        return list(self._names)
+
+    def get(self, name):
+        self._refresh()
+        return self._entries.get(name)
+
+    def page(self, offset, limit):
+        """(entries, total) for one slice of the name-ordered gallery."""
+        self._refresh()
+        names, entries = self._names, self._entries
+        return [entries[n] for n in names[offset:offset + limit]], len(names)
+
+
+GALLERY = GalleryManifest(app.config['UPLOAD_FOLDER'], GALLERY_MANIFEST)
+
+
+class GalleryVariants:
+    """
+    Builds the resized copies of a gallery image the page serves instead of
+    the original: a 200px thumbnail (the strip shows 100px tiles) and a few
+    responsive widths, each as WebP and, when Pillow has the codec, AVIF.
+
+    EXIF orientation is applied to the pixels and no metadata is carried over.
+    Files go next to the original as `<stem>.<label>.<sha256[:12]>.<ext>`, so
+    a changed original never reuses a cached URL, and the list is stored in
+    the image's manifest entry under `variants`. Uploads are processed on a
+    small thread pool (Pillow releases the GIL while resizing and encoding);
+    the backfill command runs the same code inline.
+    """
+
+    THUMB_WIDTH = 200
+    WIDTHS = (480, 960, 1600)
+    QUALITY = {'webp': 80, 'avif': 55}
+
+    def __init__(self, manifest, max_workers=2):
+        self.manifest = manifest
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def formats(self):
+        if Image is None:
+            return ()
+        return tuple(f for f in ('avif', 'webp') if pil_features.check(f))
+
+    def _executor_for_pid(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gallery-variants")
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, name):
+        if self.formats():
+            self._executor_for_pid().submit(self._process_logged, name)
+
+    def _process_logged(self, name):
+        try:
+            variants = self.process(name)
+            log_json("gallery_variants_built", name=name, count=len(variants))
+        except Exception as e:
+            log_json("gallery_variants_failed", name=name, type=type(e).__name__, message=str(e))
+
+    def _encode(self, im, fmt):
+        buf = io.BytesIO()
+        if fmt == 'webp':
+            im.save(buf, 'WEBP', quality=self.QUALITY['webp'], method=4)
+        else:
+            im.save(buf, 'AVIF', quality=self.QUALITY['avif'], speed=8)
+        return buf.getvalue()
+
+    def _write(self, stem, label, fmt, data):
+        name = f"{stem}.{label}.{hashlib.sha256(data).hexdigest()[:12]}.{fmt}"
+        path = os.path.join(self.manifest.folder, name)
+        if not os.path.exists(path):
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return name
+
+    def process(self, name):
+        """Build, write and record every variant of one gallery image; returns the variant list."""
+        stem = os.path.splitext(name)[0]
+        variants = []
+        with Image.open(os.path.join(self.manifest.folder, name)) as src:
+            if getattr(src, 'is_animated', False):
+                return []  # keep animated GIFs as they are
+            im = ImageOps.exif_transpose(src)
+            has_alpha = im.mode in ('RGBA', 'LA') or (im.mode == 'P' and 'transparency' in im.info)
+            im = im.convert('RGBA' if has_alpha else 'RGB')
+            widths = [w for w in self.WIDTHS if w < im.width]
+            if im.width < max(self.WIDTHS):
+                widths.append(im.width)  # a smaller original still needs a full-size variant in the srcset
+            targets = [(f"w{w}", w) for w in widths] + [('thumb', self.THUMB_WIDTH)]
+            resized = im
+            for label, width in sorted(targets, key=lambda t: -t[1]):
+                # Largest first, each one scaled down from the previous
+                if width < resized.width:
+                    height = max(1, round(im.height * width / im.width))
+                    resized = resized.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+                for fmt in self.formats():
+                    variants.append({
+                        'label': label,
+                        'format': fmt,
+                        'width': resized.width,
+                        'height': resized.height,
+                        'name': self._write(stem, label, fmt, self._encode(resized, fmt)),
+                    })
+        self.manifest.set_variants(name, variants)
+        return variants
+
+    def discard(self, entry):
+        """Remove the variant files of a deleted image."""
+        for variant in (entry or {}).get('variants', []):
+            try:
+                os.remove(os.path.join(self.manifest.folder, variant['name']))
+            except OSError:
+                pass
+
+
+GALLERY_VARIANTS = GalleryVariants(GALLERY)
+
+
+def gallery_srcset(entry, fmt, thumb=False):
+    """`srcset` value for one format of an image's variants ('' when it has none)."""
+    return ", ".join(
+        f"{url_for('static', filename='images/gallery1/' + v['name'])} {v['width']}w"
+        for v in entry.get('variants', [])
+        if v['format'] == fmt and (v['label'] == 'thumb') == thumb
+    )
+
+app.jinja_env.globals['gallery_srcset'] = gallery_srcset
+
+
+@app.cli.command("backfill-gallery-variants")
+@click.option("--force", is_flag=True, help="Rebuild images that already have variants.")
+def backfill_gallery_variants_command(force):
+    """Build thumbnails and responsive variants for images already in the gallery."""
+    if not GALLERY_VARIANTS.formats():
+        print("Pillow has no WebP/AVIF support; nothing to do")
+        return
+    done = 0
+    for name in GALLERY.names():
+        if (GALLERY.get(name) or {}).get('variants') and not force:
+            continue
+        try:
+            variants = GALLERY_VARIANTS.process(name)
+            done += 1
+            print(f"{name}: {len(variants)} variant(s)")
+        except Exception as e:
+            print(f"{name}: failed ({e})")
+    print(f"gallery variants built for {done} image(s)")
+
+
+# ------------------
+# Streaming uploads
+# ------------------
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # multipart boundaries, headers and the other fields
+
+# Leading bytes of the formats in ALLOWED_EXTENSIONS -> extension to store under
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+)
+SNIFF_BYTES = max(len(sig) for sig, _ in IMAGE_SIGNATURES)
+
+
+def sniff_image(head):
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+
+class UploadSink:
+    """
+    File object werkzeug's multipart parser writes an uploaded image into,
+    chunk by chunk, in place of its default spooled temp file.
+
+    The data goes straight to a `.part` file in the upload folder (same
+    filesystem, so commit() is a rename), is hashed as it arrives, and is
+    checked as it arrives: the magic bytes once the first SNIFF_BYTES are in
+    (415 otherwise) and the running size against max_bytes (413). Raising
+    from write() stops the parser, so the rest of the body is never read.
+    An uncommitted file is deleted on close().
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.path = os.path.join(folder, f".upload-{uuid.uuid4().hex}.part")
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.extension = None
+        self._head = b''
+        self._digest = hashlib.sha256()
+        self._file = open(self.path, 'w+b')
+        self._committed = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge(f"Uploads are limited to {self.max_bytes} bytes")
+        if len(self._head) < SNIFF_BYTES:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= SNIFF_BYTES:
+                self.extension = sniff_image(self._head)
+                if self.extension is None:
+                    self.close()
+                    raise UnsupportedMediaType("Only PNG, JPEG and GIF images can be uploaded")
+        self._digest.update(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def commit(self, dst):
+        """Move the finished upload to its final path."""
+        self._file.close()
+        os.replace(self.path, dst)
+        self._committed = True
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self._committed:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class StreamingUploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'upload':
+            return UploadSink(app.config['UPLOAD_FOLDER'], UPLOAD_MAX_BYTES)
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+app.request_class = StreamingUploadRequest
+
+
+# ------------------
+# Static assets: content-hashed URLs, long-lived caching, precompressed copies
+# ------------------
+try:
+    import brotli
+except ImportError:  # .br copies are optional
+    brotli = None
+
+ASSET_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.mjs', '.json', '.map', '.svg', '.html', '.txt', '.md', '.xml'}
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))  # preference order
+GALLERY_STATIC_PREFIX = 'images/gallery1/'
+AVATAR_STATIC_PREFIX = 'avatars/'
+AVATAR_NAME_RE = re.compile(r'^([0-9a-f]{64})-\d+\.webp$')
+VARIANT_HASH_RE = re.compile(r'\.([0-9a-f]{12})\.(?:webp|avif)$')
+
+
+class AssetManifest:
+    """
+    Content hash of every file under static/, computed once at startup, plus
+    which precompressed siblings (`<file>.br`, `<file>.gz`, written by
+    `flask build-assets`) are at least as new as the file. The gallery folder
+    is skipped: GALLERY already hashes those files and they change at runtime.
+    """
+
+    def __init__(self, root, skip=()):
+        self.root = root
+        self.skip = {os.path.normpath(p) for p in skip}
+        self._entries = {}
+
+    def scan(self):
+        entries = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            rel_dir = os.path.relpath(dirpath, self.root)
+            dirnames[:] = [d for d in dirnames if os.path.normpath(os.path.join(rel_dir, d)) not in self.skip]
+            for fn in filenames:
+                if fn.endswith(tuple(ext for _, ext in PRECOMPRESSED)):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    digest = hashlib.sha256()
+                    with open(path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b''):
+                            digest.update(chunk)
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                encodings = tuple(
+                    enc for enc, ext in PRECOMPRESSED
+                    if os.path.exists(path + ext) and os.path.getmtime(path + ext) >= mtime
+                )
+                rel = os.path.relpath(path, self.root).replace(os.sep, '/')
+                entries[rel] = (digest.hexdigest()[:12], encodings)
+        self._entries = entries
+        return len(entries)
+
+    def version(self, filename):
+        entry = self._entries.get(filename)
+        return entry[0] if entry else None
+
+    def encodings(self, filename):
+        entry = self._entries.get(filename)
+        return entry[1] if entry else ()
+
+    def files(self):
+        return list(self._entries)
+
+
+ASSETS = AssetManifest(app.static_folder, skip=(GALLERY_STATIC_PREFIX, AVATAR_STATIC_PREFIX))
+if not HASH_WORKER:
+    ASSETS.scan()
+
+
+def static_version(filename):
+    """Content hash for a static file, or None when it isn't known."""
+    if filename.startswith(GALLERY_STATIC_PREFIX):
+        name = filename[len(GALLERY_STATIC_PREFIX):]
+        match = VARIANT_HASH_RE.search(name)  # variants carry their hash in the name
+        if match:
+            return match.group(1)
+        entry = GALLERY.get(name)
+        return entry['sha256'][:12] if entry else None
+    if filename.startswith(AVATAR_STATIC_PREFIX):
+        match = AVATAR_NAME_RE.match(filename[len(AVATAR_STATIC_PREFIX):])  # content-addressed
+        return match.group(1)[:12] if match else None
+    return ASSETS.version(filename)
+
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    # url_for('static', filename=...) -> /static/...?v=<content hash>
+    if endpoint == 'static' and 'v' not in values:
+        version = static_version(values.get('filename', ''))
+        if version:
+            values['v'] = version
+
+
+def serve_static(filename):
+    """The `static` endpoint, with immutable caching for current hashed URLs and precompressed bodies."""
+    encodings = ASSETS.encodings(filename)
+    encoding = next((enc for enc in encodings if enc in request.accept_encodings), None)
+    if encoding:
+        ext = dict(PRECOMPRESSED)[encoding]
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        resp = send_from_directory(app.static_folder, filename + ext, mimetype=mimetype)
+        resp.headers['Content-Encoding'] = encoding
+    else:
+        resp = app.send_static_file(filename)
+    if encodings:
+        resp.vary.add('Accept-Encoding')
+
+    version = request.args.get('v')
+    if version and version == static_version(filename):
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = ASSET_IMMUTABLE_MAX_AGE
+        resp.cache_control.immutable = True
+    return resp
+
+app.view_functions['static'] = serve_static
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """Write .gz (and .br, with the brotli module) copies of compressible static files."""
+    written = 0
+    for rel in ASSETS.files():
+        if os.path.splitext(rel)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+            continue
+        path = os.path.join(app.static_folder, rel)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < 1024:
+            continue
+        compressors = [('.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            compressors.append(('.br', lambda d: brotli.compress(d, quality=11)))
+        for ext, compress in compressors:
+            packed = compress(data)
+            if len(packed) >= len(data):
+                continue
+            tmp = f"{path}{ext}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(packed)
+            os.replace(tmp, path + ext)
+            written += 1
+    ASSETS.scan()
+    print(f"precompressed {written} file(s){'' if brotli else ' (gzip only: brotli module not installed)'}")
+
+
 @app.route('/')
 def index():
-    images = sorted(os.listdir(app.config['UPLOAD_FOLDER']))
+    images, total = GALLERY.page(0, GALLERY_PAGE_SIZE)
     logged_in = session.get('logged_in', False)
-    return render_template('index.html', images=images, logged_in=logged_in)
+    return render_template('index.html', images=images, total_images=total,
+                           page_size=GALLERY_PAGE_SIZE, logged_in=logged_in)
+
+
+@app.route('/api/gallery')
+def gallery_page():
+    """
+    One page of the gallery manifest, for lazy loading.
+      /api/gallery?page=2&limit=24
+    """
+    page = max(1, request.args.get('page', 1, type=int))
+    limit = max(1, min(request.args.get('limit', GALLERY_PAGE_SIZE, type=int), 200))
+    images, total = GALLERY.page((page - 1) * limit, limit)
+    return jsonify({
+        "status": "ok",
+        "page": page,
+        "total": total,
+        "hasMore": page * limit < total,
+        "images": [
+            dict(e,
+                 url=url_for('static', filename='images/gallery1/' + e['name']),
+                 thumbSrcset={f: gallery_srcset(e, f, thumb=True) for f in ('avif', 'webp')},
+                 srcset={f: gallery_srcset(e, f) for f in ('avif', 'webp')})
+            for e in images
+        ],
+    })
 
 @app.route('/login', methods=['POST'])
 @limiter.limit("5 per minute")  # rate limit to prevent brute-force
 def login():
     pin = request.form.get('pin', '')
-    if check_password_hash(SECRET_PIN_HASH, pin):
+    try:
+        ok = PASSWORD_HASHER.verify(SECRET_PIN_HASH, pin)
+    except PasswordHasherBusy:
+        return 'Too many login attempts, try again shortly', 503, {'Retry-After': '2'}
+    if ok:
         session['logged_in'] = True
     else:
         session['logged_in'] = False
@@ -102,18 +824,36 @@ def logout():
 def upload():
     if not session.get('logged_in'):
         return 'Unauthorized', 403
-    if 'image' not in request.files:
-        return 'No image part', 400
+    # Cap the body before request.files starts parsing it into UploadSink
+    request.max_content_length = UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD
+    try:
+        if 'image' not in request.files:
+            return 'No image part', 400
+    except RequestEntityTooLarge:
+        return 'File too large', 413
+    except UnsupportedMediaType:
+        return 'Invalid file type', 415
     file = request.files['image']
     if file.filename == '':
         return 'No selected file', 400
-    if file and allowed_file(file.filename):
-        original_filename = secure_filename(file.filename)
-        extension = os.path.splitext(original_filename)[1]
-        unique_name = f"{uuid.uuid4().hex}{extension}"
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], unique_name))
+    sink = file.stream
+    if not isinstance(sink, UploadSink) or sink.extension is None:
+        return 'Invalid file type', 400
+
+    # Same bytes as an image already in the gallery: keep the existing one
+    if GALLERY.find_by_hash(sink.sha256) is not None:
+        sink.close()
         return redirect(url_for('index'))
-    return 'Invalid file type', 400
+
+    unique_name = f"{uuid.uuid4().hex}{sink.extension}"
+    final_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_name)
+    sink.commit(final_path)
+    entry = GALLERY.add(unique_name, sha256=sink.sha256)
+    if entry['name'] != unique_name:  # a concurrent upload of the same file won
+        os.remove(final_path)
+    else:
+        GALLERY_VARIANTS.submit(unique_name)
+    return redirect(url_for('index'))
 
 @app.route('/delete', methods=['POST'])
 def delete():
@@ -125,6 +865,7 @@ def delete():
     trash_path = os.path.join(TRASH_FOLDER, safe_filename)
     if os.path.exists(file_path):
         shutil.move(file_path, trash_path)
+        GALLERY_VARIANTS.discard(GALLERY.remove(safe_filename))
         return redirect(url_for('index'))
     return 'File not found', 404
 
@@ -153,6 +894,34 @@ def webkit_to_datetime(webkit_timestamp):
         return None
     return datetime(1601, 1, 1) + timedelta(microseconds=webkit_timestamp)
 
+WEBKIT_EPOCH = np.datetime64('1601-01-01T00:00:00', 'us')
+
+def webkit_to_iso_batch(webkit_timestamps, sep='T', seconds_only=False, missing=None):
+    """
+    Format a column of webkit timestamps in one pass with datetime64 arithmetic.
+    Matches webkit_to_datetime(ts).isoformat(sep) per row (no fraction when the
+    microseconds are zero), or strftime('%Y-%m-%d %H:%M:%S') style with
+    seconds_only=True. Falsy timestamps become `missing`.
+    """
+    ts = np.fromiter((t or 0 for t in webkit_timestamps), dtype=np.int64)
+    if ts.size == 0:
+        return []  # np.char.replace can't take an empty array
+    stamps = WEBKIT_EPOCH + ts.astype('timedelta64[us]')
+    if seconds_only:
+        text = np.datetime_as_string(stamps, unit='s')
+    else:
+        text = np.datetime_as_string(stamps, unit='us')
+        whole = ts % 1_000_000 == 0
+        if whole.any():
+            text = text.astype(object)
+            text[whole] = np.datetime_as_string(stamps[whole], unit='s')
+            text = text.astype(str)
+    if sep != 'T':
+        text = np.char.replace(text, 'T', sep)
+    out = text.astype(object)
+    out[ts == 0] = missing
+    return out.tolist()
+
 def datetime_to_webkit(dt_str):
     try:
         dt = datetime.strptime(dt_str, "%Y-%m-%d")
@@ -162,6 +931,57 @@ def datetime_to_webkit(dt_str):
         return None
 
 
+# Keyset pagination: rows are ordered by (sort key, visit id, search-term rowid),
+# all DESC, and a cursor is the key of the row at the edge of the current page.
+HISTORY_SORT_KEYS = {
+    'date': 'v.visit_time',
+    'title': "COALESCE(u.title, '')",
+    'url': "COALESCE(u.url, '')",
+}
+HISTORY_TIE_KEYS = "v.id, COALESCE(k.rowid, 0)"
+
+def encode_history_cursor(row_key):
+    return _b64u(json.dumps(list(row_key), separators=(",", ":")).encode("utf-8"))
+
+def decode_history_cursor(cursor):
+    try:
+        key = json.loads(_b64u_decode(cursor))
+        if isinstance(key, list) and len(key) == 3:
+            return key
+    except Exception:
+        pass
+    return None
+
+
+# Total row counts per filter set, so paging doesn't re-run COUNT(*) on every
+# click. Keyed by the History file's mtime: a new snapshot starts fresh.
+_HISTORY_COUNTS = OrderedDict()
+_HISTORY_COUNTS_LOCK = threading.Lock()
+_HISTORY_COUNTS_MAX = 256
+
+def cached_history_count(conn, where_clause, values):
+    try:
+        mtime = os.path.getmtime(HISTORY_DB)
+    except OSError:
+        mtime = None
+    key = (mtime, where_clause, tuple(values))
+    with _HISTORY_COUNTS_LOCK:
+        if key in _HISTORY_COUNTS:
+            _HISTORY_COUNTS.move_to_end(key)
+            return _HISTORY_COUNTS[key]
+    total = conn.execute(f"""
+        SELECT COUNT(*) FROM urls u
+        JOIN visits v ON u.id = v.url
+        LEFT JOIN keyword_search_terms k ON k.url_id = u.id
+        {where_clause}
+    """, values).fetchone()[0]
+    with _HISTORY_COUNTS_LOCK:
+        _HISTORY_COUNTS[key] = total
+        while len(_HISTORY_COUNTS) > _HISTORY_COUNTS_MAX:
+            _HISTORY_COUNTS.popitem(last=False)
+    return total
+
+
 @app.route('/history')
 def history():
     query = request.args.get('query', '').strip()
@@ -170,25 +990,37 @@ def history():
     date_to = request.args.get('date_to', '')
     visit_type = request.args.get('visit_type', '')
     sort = request.args.get('sort', 'date')
-    page = request.args.get('page', 1, type=int)
+    after = decode_history_cursor(request.args.get('after', ''))
+    before = decode_history_cursor(request.args.get('before', ''))
+    page = max(1, request.args.get('page', 1, type=int)) if (after or before) else 1
     per_page = 50
-    offset = (page - 1) * per_page
     results, total, total_pages, status = [], 0, 1, ''
+    next_cursor = prev_cursor = None
 
-    sort_column = {
-        'date': 'v.visit_time',
-        'title': 'u.title',
-        'url': 'u.url'
-    }.get(sort, 'v.visit_time')
+    if sort not in HISTORY_SORT_KEYS:
+        sort = 'date'
+    sort_key = HISTORY_SORT_KEYS[sort]
+    row_key = f"{sort_key}, {HISTORY_TIE_KEYS}"
 
     filters = []
     values = []
 
+    if query and history_index_ready(query):
+        # The index finds candidate urls; the LIKE then applies per joined
+        # keyword row, so results match the unindexed search exactly
+        filters.append("u.id IN (SELECT rowid FROM hidx.url_fts WHERE url_fts MATCH ?)")
+        values.append(HistoryIndex.phrase(query))
     if query:
         filters.append("(u.title LIKE ? OR u.url LIKE ? OR k.term LIKE ?)")
         values += ['%' + query + '%'] * 3
 
-    if domain:
+    domain_host = normalize_host(domain) if domain else ''
+    if domain_host and history_sidecar_ready():
+        # The host itself or any subdomain: one range on the reversed-host index
+        rhost = reverse_host(domain_host)
+        filters.append("u.id IN (SELECT url_id FROM hidx.url_host WHERE rhost = ? OR (rhost > ? AND rhost < ?))")
+        values += [rhost, rhost + '.', rhost + '/']
+    elif domain:
         filters.append("u.url LIKE ?")
         values.append(f"%{domain}%")
 
@@ -215,45 +1047,62 @@ def history():
 
     where_clause = "WHERE " + " AND ".join(filters) if filters else ""
 
-    try:
-        conn = conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-
-        count_query = f"""
-            SELECT COUNT(*) FROM urls u
-            JOIN visits v ON u.id = v.url
-            LEFT JOIN keyword_search_terms k ON k.url_id = u.id
-            {where_clause}
-        """
-        cursor.execute(count_query, values)
-        total = cursor.fetchone()[0]
-
-        query_stmt = f"""
-            SELECT u.id, u.title, u.url, v.visit_time, v.transition, k.term
-            FROM urls u
-            JOIN visits v ON u.id = v.url
-            LEFT JOIN keyword_search_terms k ON k.url_id = u.id
-            {where_clause}
-            ORDER BY {sort_column} DESC
-            LIMIT ? OFFSET ?
-        """
-        cursor.execute(query_stmt, values + [per_page, offset])
-        rows = cursor.fetchall()
-        conn.close()
+    # Page window: seek past the cursor instead of OFFSET-scanning to it. The
+    # extra (redundant) bound on the bare sort key lets SQLite use its index.
+    page_filters, page_values = list(filters), list(values)
+    if after:
+        page_filters += [f"{sort_key} <= ?", f"({row_key}) < (?, ?, ?)"]
+        page_values += [after[0]] + after
+    elif before:
+        page_filters += [f"{sort_key} >= ?", f"({row_key}) > (?, ?, ?)"]
+        page_values += [before[0]] + before
+    page_where = "WHERE " + " AND ".join(page_filters) if page_filters else ""
+    direction = "ASC" if before else "DESC"
 
+    try:
+        with get_history_db() as conn:
+            total = cached_history_count(conn, where_clause, values)
+
+            query_stmt = f"""
+                SELECT u.id, u.title, u.url, v.visit_time, v.transition, k.term,
+                       {row_key}
+                FROM urls u
+                JOIN visits v ON u.id = v.url
+                LEFT JOIN keyword_search_terms k ON k.url_id = u.id
+                {page_where}
+                ORDER BY {sort_key} {direction}, v.id {direction}, COALESCE(k.rowid, 0) {direction}
+                LIMIT ?
+            """
+            rows = conn.execute(query_stmt, page_values + [per_page + 1]).fetchall()
+
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        if before:
+            rows.reverse()
+        if rows:
+            first_key, last_key = tuple(rows[0])[6:], tuple(rows[-1])[6:]
+            if (has_more if not before else True):
+                next_cursor = encode_history_cursor(last_key)
+            if (has_more if before else bool(after)):
+                prev_cursor = encode_history_cursor(first_key)
+        if before and not has_more:
+            page = 1  # paged back to the start
+
+        dates = webkit_to_iso_batch((row[3] for row in rows), sep=' ', seconds_only=True, missing="Unknown")
         results = [
             {
                 'id': row[0],
                 'title': row[1],
                 'url': row[2],
-                'date': webkit_to_datetime(row[3]).strftime('%Y-%m-%d %H:%M:%S') if row[3] else "Unknown",
+                'date': date,
                 'transition': row[4],
                 'term': row[5]
             }
-            for row in rows
+            for row, date in zip(rows, dates)
         ]
 
-        total_pages = (total + per_page - 1) // per_page
+        total_pages = max(1, (total + per_page - 1) // per_page)
+        page = min(page, total_pages)
         status = f"Showing page {page} of {total_pages}, {total} total record(s)."
 
     except Exception as e:
@@ -270,6 +1119,8 @@ def history():
         sort=sort,
         page=page,
         total_pages=total_pages,
+        next_cursor=next_cursor,
+        prev_cursor=prev_cursor,
         status=status
     )
 
@@ -277,10 +1128,81 @@ def history():
 
 
 
+EXPORT_FORMATS = {
+    'json':   ('application/json', None),
+    'ndjson': ('application/x-ndjson', 'history.ndjson'),
+    'csv':    ('text/csv; charset=utf-8', 'history.csv'),
+}
+EXPORT_BATCH = 1000
+
+
+def _export_records(rows):
+    dates = webkit_to_iso_batch(row[3] for row in rows)
+    for row, date in zip(rows, dates):
+        yield {
+            'id': row[0],
+            'title': row[1],
+            'url': row[2],
+            'date': date
+        }
+
+
+def _export_chunks(fmt, sql, params):
+    """Yield the export as text chunks, one per EXPORT_BATCH rows fetched from the cursor."""
+    with get_history_db() as conn:
+        cursor = conn.execute(sql, params)
+        if fmt == 'json':
+            yield '['
+        elif fmt == 'csv':
+            yield 'id,title,url,date\r\n'
+        first = True
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH)
+            if not rows:
+                break
+            records = _export_records(rows)
+            if fmt == 'json':
+                chunk = ','.join(json.dumps(r) for r in records)
+                yield chunk if first else ',' + chunk
+            elif fmt == 'ndjson':
+                yield ''.join(json.dumps(r) + '\n' for r in records)
+            else:
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                writer.writerows((r['id'], r['title'], r['url'], r['date']) for r in records)
+                yield buf.getvalue()
+            first = False
+        if fmt == 'json':
+            yield ']'
+
+
+def _gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = z.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield z.flush()
+
+
+def _logged_stream(chunks):
+    # Once the status line is out an error can't become a 500; log it and cut the body short.
+    try:
+        yield from chunks
+    except Exception as e:
+        log_json("history_export_failed", error=str(e))
+
+
 @app.route('/export_history')
 def export_history():
+    """Stream the (optionally filtered) urls table as json, ndjson or csv, optionally gzipped."""
     query = request.args.get('query', '')
     sort = request.args.get('sort', 'date')
+    fmt = request.args.get('format', 'json')
+    want_gzip = request.args.get('gzip', '') in ('1', 'true', 'yes')
+
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"unsupported format: {fmt}"}), 400
 
     sort_column = {
         'date': 'last_visit_time',
@@ -288,39 +1210,30 @@ def export_history():
         'url': 'url'
     }.get(sort, 'last_visit_time')
 
-    try:
-        conn = conn = sqlite3.connect(HISTORY_DB)
-        cursor = conn.cursor()
-
-        if query:
-            cursor.execute(f"""
-                SELECT id, title, url, last_visit_time FROM urls
-                WHERE title LIKE ? OR url LIKE ?
-                ORDER BY {sort_column} DESC
-            """, ('%' + query + '%', '%' + query + '%'))
-        else:
-            cursor.execute(f"""
-                SELECT id, title, url, last_visit_time FROM urls
-                ORDER BY {sort_column} DESC
-            """)
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = [
-            {
-                'id': row[0],
-                'title': row[1],
-                'url': row[2],
-                'date': webkit_to_datetime(row[3]).isoformat() if row[3] else None
-            }
-            for row in rows
-        ]
-        return jsonify(data)
+    sql = "SELECT id, title, url, last_visit_time FROM urls"
+    params = ()
+    if query:
+        sql += " WHERE title LIKE ? OR url LIKE ?"
+        params = ('%' + query + '%', '%' + query + '%')
+    sql += f" ORDER BY {sort_column} DESC"
 
+    # Fail fast (with a real 500) if the History DB can't be opened at all
+    try:
+        with get_history_db() as conn:
+            conn.execute("SELECT 1 FROM urls LIMIT 1")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    content_type, filename = EXPORT_FORMATS[fmt]
+    body = _logged_stream(_export_chunks(fmt, sql, params))
+    headers = {}
+    if filename:
+        headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if want_gzip:
+        body = _gzip_chunks(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, content_type=content_type, headers=headers)
+
 
 
 
@@ -530,56 +1443,253 @@ def export_history():
 
 
 
-@app.route('/users')
-@login_required
-def users():
-    query = request.args.get('query', '').lower()
-    filter_type = request.args.get('filter_type', 'name')
-    selected = query  # for use in client/company selection display
-    results = []
-    companies, names = [], []
-    
-    try:
-        with open('all-users-cleaned.json', 'r') as f:
-            all_users = json.load(f)
+# ------------------
+# User directory (all-users-cleaned.json, loaded once per file version)
+# ------------------
+USERS_JSON = os.environ.get("USERS_JSON_PATH") or rel_path("all-users-cleaned.json")
+
 
-        # Deduplicate
+class UserDirectorySnapshot:
+    """One parsed version of the directory file, with everything /users needs precomputed."""
+
+    def __init__(self, all_users):
+        # Deduplicate on (name, email, company), keeping first-seen order
         seen = set()
-        unique_users = []
+        self.users = []
         for user in all_users:
             key = (user.get('name'), user.get('email'), user.get('company'))
             if key not in seen:
                 seen.add(key)
-                unique_users.append(user)
+                self.users.append(user)
 
-        # Collect for display
-        companies = sorted(set(user['company'] for user in unique_users if user.get('company')))
-        names = sorted(set(user['name'] for user in unique_users if user.get('name')))
+        self.by_company = {}
+        self.by_name = {}
+        for user in self.users:
+            self.by_company.setdefault((user.get('company') or '').lower(), []).append(user)
+            self.by_name.setdefault((user.get('name') or '').lower(), []).append(user)
 
-        if filter_type == 'company' and query:
-            results = [u for u in unique_users if u.get('company', '').lower() == query]
-        elif filter_type == 'name' and query:
-            results = [u for u in unique_users if u.get('name', '').lower() == query]
-        elif filter_type == 'name':
-            results = unique_users  # fallback: show all
+        self._search_index = None
+        self._search_lock = threading.Lock()
 
-    except Exception as e:
-        results = []
-        companies = []
-        names = []
+    @property
+    def search_index(self):
+        """Built on first use: /users itself never needs it."""
+        if self._search_index is None:
+            with self._search_lock:
+                if self._search_index is None:
+                    self._search_index = UserSearchIndex(self.users)
+        return self._search_index
+
+
+def _trigram_codes(texts):
+    """
+    Trigrams of each text (padded as '  text ') packed into uint64s, three
+    21-bit code points each, computed for all texts at once. Returns
+    (codes, text_index) arrays; a trigram repeated within a text repeats.
+    """
+    padded = [f"  {t} " for t in texts]
+    lens = np.fromiter((len(t) for t in padded), dtype=np.int64, count=len(padded))
+    cps = np.frombuffer(''.join(padded).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(cps) < 3:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    codes = (cps[:-2] << np.uint64(42)) | (cps[1:-1] << np.uint64(21)) | cps[2:]
+    owner = np.repeat(np.arange(len(padded)), lens)[:len(codes)]
+    offset = np.arange(len(codes)) - (np.cumsum(lens) - lens)[owner]
+    valid = offset <= lens[owner] - 3  # drop windows that straddle two texts
+    return codes[valid], owner[valid]
+
+
+class UserSearchIndex:
+    """
+    Autocomplete over name, email and company.
+
+    Prefix matches come from a sorted token list (whole name / email / company
+    plus each word of them) searched with bisect. Fuzzy matches come from a
+    trigram inverted index kept as flat numpy arrays (sorted trigram codes,
+    and the user ids for each code as one contiguous slice): the query's
+    trigrams are looked up with searchsorted, their postings counted with
+    np.bincount, and users sharing at least FUZZY_MIN_SHARE of the query's
+    trigrams rank by overlap. Prefix hits are listed first, then fuzzy ones.
+    """
+
+    FUZZY_MIN_SHARE = 0.4
+
+    def __init__(self, users):
+        self.users = users
+        keys, ids = [], []
+        texts, text_user = [], []
+        for idx, user in enumerate(users):
+            tokens = set()
+            for field in ('name', 'email', 'company'):
+                text = (user.get(field) or '').lower()
+                if not text:
+                    continue
+                texts.append(text)
+                text_user.append(idx)
+                tokens.add(text)
+                tokens.update(text.replace('@', ' ').replace('.', ' ').split())
+            keys.extend(tokens)
+            ids.extend([idx] * len(tokens))
+
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._keys = [keys[i] for i in order]
+        self._ids = [ids[i] for i in order]
+
+        codes, text_index = _trigram_codes(texts)
+        owners = np.asarray(text_user, dtype=np.int32)[text_index]
+        order = np.lexsort((owners, codes))
+        codes, owners = codes[order], owners[order]
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (owners[1:] != owners[:-1])
+        codes, owners = codes[first], owners[first]  # one posting per (trigram, user)
+        self._gram_codes, self._gram_starts = np.unique(codes, return_index=True)
+        self._gram_ends = np.append(self._gram_starts[1:], len(codes))
+        self._gram_owners = owners
+
+    def _prefix_ids(self, q):
+        lo = bisect.bisect_left(self._keys, q)
+        hi = bisect.bisect_left(self._keys, q + '\uffff')
+        seen = set()
+        for i in range(lo, hi):
+            idx = self._ids[i]
+            if idx not in seen:
+                seen.add(idx)
+                yield idx
+
+    def _fuzzy_ids(self, q):
+        qcodes = np.unique(_trigram_codes([q])[0])
+        need = max(1, int(np.ceil(len(qcodes) * self.FUZZY_MIN_SHARE)))
+        if not len(self._gram_codes):
+            return []
+        pos = np.minimum(np.searchsorted(self._gram_codes, qcodes), len(self._gram_codes) - 1)
+        pos = pos[self._gram_codes[pos] == qcodes]
+        if len(pos) < need:
+            return []
+        postings = [self._gram_owners[self._gram_starts[p]:self._gram_ends[p]] for p in pos]
+        counts = np.bincount(np.concatenate(postings), minlength=len(self.users))
+        hits = np.nonzero(counts >= need)[0]
+        order = np.lexsort((hits, -counts[hits]))  # most shared trigrams first, then file order
+        return hits[order].tolist()
+
+    def search(self, q, offset=0, limit=20):
+        """(users, has_more) for one page of results."""
+        q = q.strip().lower()
+        if not q:
+            return [], False
+        want = offset + limit + 1
+        ids, seen = [], set()
+        for idx in self._prefix_ids(q):
+            ids.append(idx)
+            seen.add(idx)
+            if len(ids) >= want:
+                break
+        if len(ids) < want and len(q) >= 3:
+            for idx in self._fuzzy_ids(q):
+                if idx not in seen:
+                    ids.append(idx)
+                    if len(ids) >= want:
+                        break
+        page = ids[offset:offset + limit]
+        return [self.users[i] for i in page], len(ids) > offset + limit
+
+
+class UserDirectory:
+    """
+    Serves the latest UserDirectorySnapshot of a JSON file. The file is stat'ed
+    at most every `check_interval` seconds and re-parsed only when its mtime
+    or size changed, so requests normally do no file I/O at all. If a reload
+    fails the previous snapshot keeps serving.
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self):
+        """Current snapshot, or None if the file has never loaded."""
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if now - self._checked_at >= self.check_interval:
+                    self._checked_at = now
+                    self._reload_if_changed()
+        return self._snapshot
+
+    def _reload_if_changed(self):
+        try:
+            st = os.stat(self.path)
+            version = (st.st_mtime_ns, st.st_size)
+            if version == self._version:
+                return
+            with open(self.path, 'r') as f:
+                self._snapshot = UserDirectorySnapshot(json.load(f))
+            self._version = version
+        except Exception as e:
+            log_json("user_directory_load_failed", path=self.path, type=type(e).__name__, message=str(e))
+
+
+USER_DIRECTORY = UserDirectory(USERS_JSON)
+
+
+@app.route('/users')
+@login_required
+def users():
+    query = request.args.get('query', '').lower()
+    filter_type = request.args.get('filter_type', 'name')
+    selected = query  # for use in client/company selection display
+    results = []
+
+    # The sidebar is filled by /api/users/search as the user types; the page
+    # itself only renders the users behind the current selection
+    directory = USER_DIRECTORY.get()
+    if directory is None:
         selected = ''
-    
+    elif filter_type == 'company' and query:
+        results = directory.by_company.get(query, [])
+    elif filter_type == 'name' and query:
+        results = directory.by_name.get(query, [])
+
     return render_template(
         'users.html',
         results=results,
         filter_type=filter_type,
         query=query,
-        selected=selected,
-        companies=companies,
-        names=names
+        selected=selected
     )
 
 
+@app.route('/api/users/search')
+@login_required
+def users_search():
+    """
+    Autocomplete for the user directory.
+      /api/users/search?q=ali&page=1&limit=20
+    """
+    q = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+
+    directory = USER_DIRECTORY.get()
+    if directory is None:
+        return jsonify({"status": "error", "message": "User directory unavailable"}), 503
+
+    found, has_more = directory.search_index.search(q, offset=(page - 1) * limit, limit=limit)
+    return jsonify({
+        "status": "ok",
+        "q": q,
+        "page": page,
+        "hasMore": has_more,
+        "results": [
+            {"name": u.get('name'), "email": u.get('email'), "company": u.get('company')}
+            for u in found
+        ],
+    })
+
+
 # # ------------------
 # # AI - image2image (Stable Diffusion img2img)
 # # ------------------
@@ -640,9 +1750,12 @@ def users():
 
 # ====== GLOBAL LEADERBOARD (secure submit + public read) ======================
 
-import os, time, json, hmac, hashlib, base64, sqlite3, uuid, traceback, logging
+import os, sys, time, json, hmac, hashlib, base64, sqlite3, uuid, traceback, logging, threading, bisect, queue, atexit, shlex
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 from flask import jsonify, request, g
 from flask_limiter.util import get_remote_address
@@ -657,6 +1770,18 @@ class Config:
     bind_to_ua: bool = True
     bind_to_ip: bool = False  # Only True if you pass real client IP (X-Forwarded-For)
     games_db_path: str = ""   # set below
+    leaderboard_cache_ttl_seconds: float = 5.0  # upper bound on staleness across workers
+    # Game inserts: "sync" (in the request), "enqueue" (ack once queued) or
+    # "flush" (ack once the writer thread has committed the batch)
+    write_mode: str = "sync"
+    write_batch_size: int = 200
+    write_flush_interval_ms: int = 20
+    # Replay protection: "memory" (per-process, no DB writes) or "sqlite"
+    # (used_nonces table, shared by every worker process). With "memory" each
+    # gunicorn worker keeps its own set, so under N workers a token can be
+    # replayed up to N-1 times (once per other worker) — use "sqlite" there.
+    nonce_backend: str = "memory"
+    nonce_window_seconds: int = 24 * 60 * 60
 
 def _abs_path(rel: str) -> str:
     base = os.path.dirname(os.path.abspath(__file__))
@@ -665,8 +1790,20 @@ def _abs_path(rel: str) -> str:
 SUBMIT_HMAC_SECRET = os.environ.get("SUBMIT_HMAC_SECRET", "")
 if not SUBMIT_HMAC_SECRET:
     raise RuntimeError("SUBMIT_HMAC_SECRET is not set. Put it in .env (SUBMIT_HMAC_SECRET=...)")
+SUBMIT_HMAC_KEY = SUBMIT_HMAC_SECRET.encode("utf-8")  # encoded once, not per token
+
+CFG = Config(
+    games_db_path=GAMES_DB,
+    leaderboard_cache_ttl_seconds=float(os.environ.get("LEADERBOARD_CACHE_TTL", "5")),
+    write_mode=os.environ.get("LEADERBOARD_WRITE_MODE", "sync").strip().lower(),
+    write_batch_size=int(os.environ.get("LEADERBOARD_WRITE_BATCH", "200")),
+    write_flush_interval_ms=int(os.environ.get("LEADERBOARD_WRITE_FLUSH_MS", "20")),
+    nonce_backend=os.environ.get("NONCE_BACKEND", "memory").strip().lower(),
+)
+if CFG.write_mode not in ("sync", "enqueue", "flush"):
+    raise RuntimeError(f"LEADERBOARD_WRITE_MODE must be sync, enqueue or flush (got {CFG.write_mode!r})")
 
-CFG = Config(games_db_path=GAMES_DB)
+LEADERBOARD_MAX_LIMIT = 200
 
 
 # ---------------------------------------------------------------------------
@@ -727,7 +1864,7 @@ def stable_key(email: Optional[str], client_id: Optional[str]) -> Optional[str]:
 
 def sign_token(payload: Dict[str, Any]) -> str:
     msg = json.dumps(payload, separators=(",", ":")).encode("utf-8")
-    sig = hmac.new(SUBMIT_HMAC_SECRET.encode("utf-8"), msg, hashlib.sha256).digest()
+    sig = hmac.new(SUBMIT_HMAC_KEY, msg, hashlib.sha256).digest()
     return _b64u(msg) + "." + _b64u(sig)
 
 def verify_token(tok: str) -> Optional[Dict[str, Any]]:
@@ -735,7 +1872,7 @@ def verify_token(tok: str) -> Optional[Dict[str, Any]]:
         msg_b64, sig_b64 = tok.split(".", 1)
         msg = _b64u_decode(msg_b64)
         sig = _b64u_decode(sig_b64)
-        calc = hmac.new(SUBMIT_HMAC_SECRET.encode("utf-8"), msg, hashlib.sha256).digest()
+        calc = hmac.new(SUBMIT_HMAC_KEY, msg, hashlib.sha256).digest()
         if not hmac.compare_digest(sig, calc):
             return None
         payload = json.loads(msg.decode("utf-8"))
@@ -749,12 +1886,178 @@ def verify_token(tok: str) -> Optional[Dict[str, Any]]:
 # SQLite
 # ---------------------------------------------------------------------------
 
-def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(CFG.games_db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout=5000;")
-    return conn
+class SQLitePool:
+    """
+    One long-lived connection per (process, thread) for a database file.
+
+    Pragmas run once per connection and the connection's statement cache
+    stays warm across requests. gunicorn's request threads each get their
+    own connection, so nothing is shared between threads; a pid check drops
+    connections inherited across fork. Any sqlite error other than a
+    constraint violation discards the connection so the next use reconnects.
+
+        with GAMES_POOL.connection() as conn:
+            conn.execute(...)
+            conn.commit()
+
+    Uncommitted work is rolled back when the outermost `with` exits, the same
+    as closing a per-call connection used to do. Nested use on one thread
+    shares the connection.
+    """
+
+    def __init__(self, path: str, pragmas: Tuple[str, ...] = (),
+                 on_connect: Optional[Callable[[sqlite3.Connection], None]] = None,
+                 **connect_kwargs: Any) -> None:
+        self.path = path
+        self.pragmas = pragmas
+        self.on_connect = on_connect
+        self.connect_kwargs = {"cached_statements": 256, **connect_kwargs}
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, **self.connect_kwargs)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        if self.on_connect is not None:
+            self.on_connect(conn)
+        return conn
+
+    def _discard(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None and getattr(self._local, "pid", None) == os.getpid():
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            local.conn = self._connect()
+            local.pid = os.getpid()
+            local.depth = 0
+        conn = local.conn
+        local.depth += 1
+        try:
+            yield conn
+        except sqlite3.IntegrityError:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        except sqlite3.Error:
+            self._discard()
+            raise
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            local.depth -= 1
+            if local.depth == 0 and local.conn is conn and conn.in_transaction:
+                conn.rollback()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        BEGIN IMMEDIATE ... COMMIT on this thread's connection. Takes the write
+        lock up front so the whole block commits (one fsync) or rolls back.
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            conn.commit()
+
+    def close(self) -> None:
+        """Close this thread's connection (tests / shutdown)."""
+        self._discard()
+
+
+def sqlite_readonly_uri(path: str, immutable: bool = True) -> str:
+    """`file:` URI opening `path` read-only; immutable also skips locking and change detection."""
+    uri = "file:" + urllib.parse.quote(os.path.abspath(path)) + "?mode=ro"
+    return uri + "&immutable=1" if immutable else uri
+
+
+class SnapshotPool(SQLitePool):
+    """
+    SQLitePool for a database file the app only reads and that is replaced as
+    a whole (a History snapshot uploaded at deploy time).
+
+    Connections open with `mode=ro&immutable=1`, so SQLite takes no locks and
+    never re-checks the file for changes; with mmap_size set, pages are served
+    straight from the OS page cache. Since SQLite won't notice a new snapshot
+    itself, each outermost connection() stats the file and reopens when its
+    mtime, size or inode moved.
+    """
+
+    @staticmethod
+    def _signature(path: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Stat before opening: a snapshot swapped in mid-open is caught next time
+        self._local.signature = self._signature(self.path)
+        conn = sqlite3.connect(sqlite_readonly_uri(self.path), uri=True, **self.connect_kwargs)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        if self.on_connect is not None:
+            self.on_connect(conn)
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        local = self._local
+        if (getattr(local, "conn", None) is not None and local.depth == 0
+                and self._signature(self.path) != getattr(local, "signature", None)):
+            self._discard()
+        with super().connection() as conn:
+            yield conn
+
+
+GAMES_POOL = SQLitePool(
+    CFG.games_db_path,
+    pragmas=("PRAGMA journal_mode=WAL;", "PRAGMA busy_timeout=5000;"),
+    detect_types=sqlite3.PARSE_DECLTYPES,
+)
+USERS_POOL = SQLitePool(
+    USERS_DB,
+    pragmas=("PRAGMA journal_mode=WAL;", "PRAGMA busy_timeout=5000;"),
+)
+# The History file is a copied Chrome database, replaced wholesale on deploy and
+# never written by the app. When the search sidecar is enabled it is attached to
+# every connection as `hidx`.
+HISTORY_POOL = SnapshotPool(
+    HISTORY_DB,
+    pragmas=(
+        f"PRAGMA mmap_size={HISTORY_MMAP_BYTES};",
+        f"PRAGMA cache_size=-{HISTORY_CACHE_KIB};",
+    ),
+    on_connect=lambda conn: attach_history_index(conn),
+)
+
+
+def get_db():
+    """Pooled games.db connection: `with get_db() as conn: ...`"""
+    return GAMES_POOL.connection()
+
+def get_users_db():
+    return USERS_POOL.connection()
+
+def get_history_db():
+    return HISTORY_POOL.connection()
 
 # Make sure files exist; avoids surprises on first boot
 for _p in (USERS_DB, GAMES_DB, HISTORY_DB):
@@ -766,13 +2069,65 @@ for _p in (USERS_DB, GAMES_DB, HISTORY_DB):
         # log but don't crash
         print(f"[DB PREP] Could not prepare {_p}: {type(e).__name__}: {e}")    
 
-def init_games_db() -> None:
-    conn = sqlite3.connect(CFG.games_db_path)
-    c = conn.cursor()
+# ---------------------------------------------------------------------------
+# Schema migrations
+# ---------------------------------------------------------------------------
+# Each database carries its schema version in PRAGMA user_version. A migration
+# list entry is a tuple of steps: SQL statements, or callables taking the
+# connection for changes that depend on what is already there.
+
+Migration = Tuple[Any, ...]
+
+def add_column_if_missing(table: str, column: str, decl: str) -> Callable[[sqlite3.Connection], None]:
+    # For columns that older code added with an ad-hoc ALTER before user_version was tracked
+    def step(conn: sqlite3.Connection) -> None:
+        if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return step
+
+def migrate(db_path: str, migrations: List[Migration]) -> int:
+    """
+    Bring db_path up to version len(migrations); migrations[i] takes it from
+    version i to i + 1. Every migration commits in its own BEGIN IMMEDIATE
+    together with the user_version bump, so workers booting at the same time
+    apply it once and a failing one leaves the last good version behind.
+    ANALYZE runs after any change so the planner has statistics for new
+    indexes. Returns how many migrations were applied.
+    """
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    applied = 0
+    try:
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(migrations):
+                    conn.execute("ROLLBACK")
+                    break
+                for step in migrations[version]:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            applied += 1
+            log_json("schema_migrated", db=os.path.basename(db_path), version=version + 1)
+        if applied:
+            conn.execute("ANALYZE")
+    finally:
+        conn.close()
+    return applied
 
-    # Games (unchanged)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS games (
+
+GAMES_MIGRATIONS: List[Migration] = [
+    # 1: baseline (databases from before user_version already have all of it)
+    (
+        """CREATE TABLE IF NOT EXISTS games (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_key TEXT,
             nickname TEXT,
@@ -783,22 +2138,17 @@ def init_games_db() -> None:
             outcome TEXT NOT NULL,
             duration_ms INTEGER,
             created_at INTEGER NOT NULL
-        )
-    """)
-    c.execute("CREATE INDEX IF NOT EXISTS idx_games_score ON games (hits_made DESC, avg_precision DESC, created_at DESC)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_games_user  ON games (user_key, created_at DESC)")
-
-    # Nonce table (unchanged)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS used_nonces (
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_games_score ON games (hits_made DESC, avg_precision DESC, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_games_user  ON games (user_key, created_at DESC)",
+        # Replay protection
+        """CREATE TABLE IF NOT EXISTS used_nonces (
             nonce TEXT PRIMARY KEY,
             seen_at INTEGER NOT NULL
-        )
-    """)
-
-    # NEW: Users table — 1 account per email, bound to one client_id
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_used_nonces_seen ON used_nonces (seen_at)",
+        # 1 account per email, bound to one client_id
+        """CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             email TEXT NOT NULL UNIQUE,
             user_key TEXT NOT NULL,
@@ -806,30 +2156,181 @@ def init_games_db() -> None:
             nickname TEXT,
             created_at INTEGER NOT NULL,
             last_seen INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_users_userkey  ON users (user_key)",
+        "CREATE INDEX IF NOT EXISTS idx_users_clientid ON users (client_id)",
+        # Best game per user_key, kept in step with `games` by record_game().
+        # The leaderboard reads this instead of ranking every historical game.
+        """CREATE TABLE IF NOT EXISTS user_best (
+            user_key TEXT PRIMARY KEY,
+            game_id INTEGER NOT NULL,
+            nickname TEXT,
+            email TEXT,
+            hits_made INTEGER NOT NULL,
+            target INTEGER NOT NULL,
+            avg_precision INTEGER NOT NULL,
+            outcome TEXT NOT NULL,
+            duration_ms INTEGER,
+            created_at INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_user_best_rank ON user_best (hits_made DESC, avg_precision DESC, created_at ASC)",
+        "CREATE INDEX IF NOT EXISTS idx_user_best_game ON user_best (game_id)",
+    ),
+    # 2: normalized emails for backfill_users_from_games_once() — an index-only
+    # DISTINCT over the games that have one instead of a full table scan
+    (
+        """CREATE INDEX IF NOT EXISTS idx_games_email_norm ON games (LOWER(TRIM(email)))
+           WHERE email IS NOT NULL AND TRIM(email) <> ''""",
+    ),
+]
+
+def init_games_db(db_path: Optional[str] = None) -> None:
+    migrate(db_path or CFG.games_db_path, GAMES_MIGRATIONS)
+
+
+def rebuild_user_best(conn: sqlite3.Connection) -> int:
+    """
+    Recompute user_best from the full games table (one-shot; used on first boot
+    after the table was introduced, or by `flask rebuild-user-best`).
+    Returns the number of users written. Caller commits.
+    """
+    conn.execute("DELETE FROM user_best")
+    conn.execute("""
+        INSERT INTO user_best (user_key, game_id, nickname, email, hits_made, target,
+                               avg_precision, outcome, duration_ms, created_at)
+        SELECT user_key, id, nickname, email, hits_made, target,
+               avg_precision, outcome, duration_ms, created_at
+        FROM (
+          SELECT *,
+            ROW_NUMBER() OVER (
+              PARTITION BY user_key
+              ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
+            ) AS rn
+          FROM games
+          WHERE user_key IS NOT NULL
         )
+        WHERE rn = 1
     """)
-    c.execute("CREATE INDEX IF NOT EXISTS idx_users_userkey  ON users (user_key)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_users_clientid ON users (client_id)")
+    return conn.execute("SELECT COUNT(*) FROM user_best").fetchone()[0]
 
-    conn.commit()
-    conn.close()
 
+def rebuild_user_best_if_empty() -> None:
+    conn = sqlite3.connect(CFG.games_db_path)
+    try:
+        has_best = conn.execute("SELECT 1 FROM user_best LIMIT 1").fetchone()
+        has_games = conn.execute("SELECT 1 FROM games LIMIT 1").fetchone()
+        if has_games and not has_best:
+            n = rebuild_user_best(conn)
+            conn.commit()
+            log_json("user_best_rebuilt", users=n)
+    finally:
+        conn.close()
 
 
+def record_game(conn: sqlite3.Connection, game: Dict[str, Any]) -> Tuple[int, bool]:
+    """
+    Insert one game row and fold it into user_best within the caller's
+    transaction. A later game only replaces the stored best when it is
+    strictly better on (hits_made, avg_precision); ties keep the earlier game,
+    matching the leaderboard's `created_at ASC` tie-break.
+    Returns (games.id, whether user_best changed). Caller commits.
+    """
+    cur = conn.execute(
+        """
+        INSERT INTO games (user_key, nickname, email, hits_made, target, avg_precision, outcome, duration_ms, created_at)
+        VALUES (:user_key, :nickname, :email, :hits_made, :target, :avg_precision, :outcome, :duration_ms, :created_at)
+        """,
+        game,
+    )
+    game_id = cur.lastrowid
+    improved = False
+    if game["user_key"] is not None:
+        cur = conn.execute(
+            """
+            INSERT INTO user_best (user_key, game_id, nickname, email, hits_made, target,
+                                   avg_precision, outcome, duration_ms, created_at)
+            VALUES (:user_key, :game_id, :nickname, :email, :hits_made, :target,
+                    :avg_precision, :outcome, :duration_ms, :created_at)
+            ON CONFLICT(user_key) DO UPDATE SET
+                game_id       = excluded.game_id,
+                nickname      = excluded.nickname,
+                email         = excluded.email,
+                hits_made     = excluded.hits_made,
+                target        = excluded.target,
+                avg_precision = excluded.avg_precision,
+                outcome       = excluded.outcome,
+                duration_ms   = excluded.duration_ms,
+                created_at    = excluded.created_at
+            WHERE (excluded.hits_made, excluded.avg_precision) > (user_best.hits_made, user_best.avg_precision)
+            """,
+            {**game, "game_id": game_id},
+        )
+        improved = cur.rowcount > 0
+    return game_id, improved
 
 
+_GAME_COLUMNS = ("user_key", "nickname", "email", "hits_made", "target",
+                 "avg_precision", "outcome", "duration_ms", "created_at")
 
-def backfill_users_from_games_once() -> None:
+def record_games(conn: sqlite3.Connection, games: List[Dict[str, Any]]) -> int:
     """
-    Populate users from existing games so first future claimant isn't blocked by history.
-    Safe to run multiple times (INSERT OR IGNORE).
+    Batch form of record_game() for the write-behind writer: two executemany
+    calls instead of two statements per game. Must run inside a write
+    transaction (BEGIN IMMEDIATE), which is what makes the ids predictable:
+    AUTOINCREMENT hands this batch consecutive ids after the current high
+    water mark. Returns how many user_best rows changed. Caller commits.
     """
-    conn = sqlite3.connect(CFG.games_db_path)
-    conn.row_factory = sqlite3.Row
-    try:
-        rows = conn.execute("""
-            SELECT DISTINCT LOWER(TRIM(email)) AS email
-            FROM games
+    if not games:
+        return 0
+    first_id = conn.execute(
+        "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'games'), 0),"
+        "           COALESCE((SELECT MAX(id) FROM games), 0)) + 1"
+    ).fetchone()[0]
+    conn.executemany(
+        f"INSERT INTO games ({', '.join(_GAME_COLUMNS)}) VALUES ({', '.join('?' * len(_GAME_COLUMNS))})",
+        [tuple(g[c] for c in _GAME_COLUMNS) for g in games],
+    )
+    last_id = conn.execute("SELECT MAX(id) FROM games").fetchone()[0]
+    if last_id != first_id + len(games) - 1:
+        raise RuntimeError(f"record_games: unexpected id range {first_id}..{last_id} for {len(games)} rows")
+    cur = conn.executemany(
+        """
+        INSERT INTO user_best (user_key, game_id, nickname, email, hits_made, target,
+                               avg_precision, outcome, duration_ms, created_at)
+        VALUES (:user_key, :game_id, :nickname, :email, :hits_made, :target,
+                :avg_precision, :outcome, :duration_ms, :created_at)
+        ON CONFLICT(user_key) DO UPDATE SET
+            game_id       = excluded.game_id,
+            nickname      = excluded.nickname,
+            email         = excluded.email,
+            hits_made     = excluded.hits_made,
+            target        = excluded.target,
+            avg_precision = excluded.avg_precision,
+            outcome       = excluded.outcome,
+            duration_ms   = excluded.duration_ms,
+            created_at    = excluded.created_at
+        WHERE (excluded.hits_made, excluded.avg_precision) > (user_best.hits_made, user_best.avg_precision)
+        """,
+        [{**g, "game_id": first_id + i} for i, g in enumerate(games) if g["user_key"] is not None],
+    )
+    return max(cur.rowcount, 0)
+
+
+
+
+
+
+def backfill_users_from_games_once() -> None:
+    """
+    Populate users from existing games so first future claimant isn't blocked by history.
+    Safe to run multiple times (INSERT OR IGNORE).
+    """
+    conn = sqlite3.connect(CFG.games_db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute("""
+            SELECT DISTINCT LOWER(TRIM(email)) AS email
+            FROM games
             WHERE email IS NOT NULL AND TRIM(email) <> ''
         """).fetchall()
         now = now_ms()
@@ -847,26 +2348,554 @@ def backfill_users_from_games_once() -> None:
         conn.close()
 
 
-init_games_db()
-backfill_users_from_games_once()
+# ---------------------------------------------------------------------------
+# Leaderboard response cache
+# ---------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: str
+    etag: str
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    Tiny per-process TTL cache of serialized JSON bodies. Writers in this
+    process call invalidate(); the TTL bounds how stale other workers get.
+    """
+
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: Dict[Any, CachedResponse] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: Any) -> Optional[CachedResponse]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def put(self, key: Any, body: str) -> CachedResponse:
+        entry = CachedResponse(
+            body=body,
+            etag=hashlib.sha1(body.encode("utf-8")).hexdigest(),
+            expires_at=time.monotonic() + self.ttl_seconds,
+        )
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "ttlSeconds": self.ttl_seconds,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": (self.hits / lookups) if lookups else None,
+                "invalidations": self.invalidations,
+            }
+
+
+LEADERBOARD_CACHE = ResponseCache(CFG.leaderboard_cache_ttl_seconds)
+
+
+# ---------------------------------------------------------------------------
+# Rank index (order statistics over user_best)
+# ---------------------------------------------------------------------------
+
+class RankIndex:
+    """
+    In-memory sorted array of every user's best-score sort key, so a global
+    rank is a bisect instead of a window function over all games.
+
+    Keys are (-hits_made, -avg_precision, created_at, game_id): ascending
+    order is leaderboard order. The index follows user_best through its
+    game_id column — any row whose game_id is newer than the last one seen
+    was inserted or improved since, whichever worker process wrote it — so
+    each lookup costs one probe on idx_user_best_game plus a bisect.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._keys: List[Tuple[int, int, int, int]] = []
+        self._by_user: Dict[str, Tuple[int, int, int, int]] = {}
+        self._last_game_id = 0
 
+    @staticmethod
+    def sort_key(row: Any) -> Tuple[int, int, int, int]:
+        return (-int(row["hits_made"]), -int(row["avg_precision"]),
+                int(row["created_at"]), int(row["game_id"]))
 
-def nonce_used(nonce: str) -> bool:
-    if not nonce:
-        return True
-    conn = get_db()
+    def rebuild(self, conn: sqlite3.Connection) -> None:
+        rows = conn.execute(
+            "SELECT user_key, game_id, hits_made, avg_precision, created_at FROM user_best"
+        ).fetchall()
+        by_user = {r["user_key"]: self.sort_key(r) for r in rows}
+        with self._lock:
+            self._by_user = by_user
+            self._keys = sorted(by_user.values())
+            self._last_game_id = max((k[3] for k in self._keys), default=0)
+
+    def sync(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            last = self._last_game_id
+        rows = conn.execute(
+            "SELECT user_key, game_id, hits_made, avg_precision, created_at FROM user_best WHERE game_id > ?",
+            (last,),
+        ).fetchall()
+        if rows:
+            with self._lock:
+                for r in rows:
+                    self._put(r["user_key"], self.sort_key(r))
+
+    def _put(self, ukey: str, key: Tuple[int, int, int, int]) -> None:
+        old = self._by_user.get(ukey)
+        if old is not None:
+            if old[3] >= key[3]:
+                return
+            i = bisect.bisect_left(self._keys, old)
+            if i < len(self._keys) and self._keys[i] == old:
+                del self._keys[i]
+        self._by_user[ukey] = key
+        bisect.insort(self._keys, key)
+        self._last_game_id = max(self._last_game_id, key[3])
+
+    def rank_of(self, conn: sqlite3.Connection, row: Any) -> int:
+        """1-based global rank for a user_best row."""
+        self.sync(conn)
+        with self._lock:
+            return bisect.bisect_left(self._keys, self.sort_key(row)) + 1
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+RANK_INDEX = RankIndex()
+
+
+def _build_rank_index() -> None:
+    with get_db() as conn:
+        RANK_INDEX.rebuild(conn)
+    GAMES_POOL.close()  # don't keep the import thread's connection around
+
+if not HASH_WORKER:
+    init_games_db()
+    backfill_users_from_games_once()
+    rebuild_user_best_if_empty()
+    _build_rank_index()
+
+
+@app.cli.command("rebuild-user-best")
+def rebuild_user_best_command():
+    """Recompute the user_best table from every row in games."""
+    conn = sqlite3.connect(CFG.games_db_path)
     try:
-        cur = conn.execute("SELECT 1 FROM used_nonces WHERE nonce = ?", (nonce,))
-        if cur.fetchone():
-            return True
-        conn.execute("INSERT INTO used_nonces (nonce, seen_at) VALUES (?, ?)", (nonce, now_ms()))
-        threshold = now_ms() - 24 * 60 * 60 * 1000
-        # >>> FIX: one-element tuple must be (threshold,) not (threshold)
-        conn.execute("DELETE FROM used_nonces WHERE seen_at < ?", (threshold,))
+        n = rebuild_user_best(conn)
         conn.commit()
-        return False
     finally:
         conn.close()
+    print(f"user_best rebuilt: {n} user(s)")
+
+
+# ---------------------------------------------------------------------------
+# Nonce replay store
+# ---------------------------------------------------------------------------
+
+class NonceStore(ABC):
+    """
+    claim() returns True the first time a nonce is seen inside the replay
+    window and False for every repeat. `conn` is the caller's open write
+    transaction, for backends that persist claims alongside the submission.
+    """
+
+    # True when claim() writes through `conn`, so the caller needs a write transaction
+    needs_conn = False
+
+    @abstractmethod
+    def claim(self, nonce: str, conn: Optional[sqlite3.Connection] = None) -> bool:
+        ...
+
+    def release(self, nonce: str, conn: Optional[sqlite3.Connection] = None) -> None:
+        """Undo a claim whose submission failed; `conn` is the still-open transaction, if any."""
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__}
+
+
+class MemoryNonceStore(NonceStore):
+    """
+    Ring of per-bucket sets (hourly by default) spanning the replay window.
+    Advancing the clock clears whole expired buckets, so expiry is O(1)
+    amortized; a lookup checks window/bucket + 1 sets. Per process only —
+    use SQLiteNonceStore when several workers must share replay protection.
+    """
+
+    def __init__(self, window_seconds: int, bucket_seconds: int = 3600) -> None:
+        self.bucket_seconds = bucket_seconds
+        n = -(-window_seconds // bucket_seconds) + 1
+        self._lock = threading.Lock()
+        self._epochs: List[int] = [-1] * n
+        self._buckets: List[set] = [set() for _ in range(n)]
+
+    def _advance(self) -> int:
+        """Recycle the slot for the current bucket if it still holds an old one."""
+        epoch = int(time.time()) // self.bucket_seconds
+        i = epoch % len(self._buckets)
+        if self._epochs[i] != epoch:
+            self._buckets[i] = set()
+            self._epochs[i] = epoch
+        return epoch
+
+    def claim(self, nonce: str, conn: Optional[sqlite3.Connection] = None) -> bool:
+        if not nonce:
+            return False
+        with self._lock:
+            epoch = self._advance()
+            oldest = epoch - len(self._buckets) + 1
+            for bucket_epoch, bucket in zip(self._epochs, self._buckets):
+                if bucket_epoch >= oldest and nonce in bucket:
+                    return False
+            self._buckets[epoch % len(self._buckets)].add(nonce)
+            return True
+
+    def release(self, nonce: str, conn: Optional[sqlite3.Connection] = None) -> None:
+        with self._lock:
+            for bucket in self._buckets:
+                bucket.discard(nonce)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"backend": "memory", "nonces": sum(len(b) for b in self._buckets)}
+
+
+class SQLiteNonceStore(NonceStore):
+    """
+    used_nonces table in games.db, shared by every worker. A claim is a single
+    INSERT OR IGNORE in the submission's transaction (so a rollback releases
+    it); expired rows are swept in bulk at most every `sweep_seconds` via
+    idx_used_nonces_seen instead of on every request.
+    """
+
+    needs_conn = True
+
+    def __init__(self, window_seconds: int, pool: "SQLitePool", sweep_seconds: int = 300) -> None:
+        self.pool = pool
+        self.window_ms = window_seconds * 1000
+        self.sweep_seconds = sweep_seconds
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def claim(self, nonce: str, conn: Optional[sqlite3.Connection] = None) -> bool:
+        if not nonce:
+            return False
+        if conn is None:
+            raise ValueError("SQLiteNonceStore.claim needs the submission's connection")
+        now = now_ms()
+        with self._lock:
+            sweep = time.monotonic() >= self._next_sweep
+            if sweep:
+                self._next_sweep = time.monotonic() + self.sweep_seconds
+        if sweep:
+            conn.execute("DELETE FROM used_nonces WHERE seen_at < ?", (now - self.window_ms,))
+        cur = conn.execute("INSERT OR IGNORE INTO used_nonces (nonce, seen_at) VALUES (?, ?)", (nonce, now))
+        return cur.rowcount == 1
+
+    def release(self, nonce: str, conn: Optional[sqlite3.Connection] = None) -> None:
+        # Inside the claiming transaction the rollback would undo the claim anyway;
+        # after it committed (write-behind flush failed) the row has to go
+        if conn is not None:
+            conn.execute("DELETE FROM used_nonces WHERE nonce = ?", (nonce,))
+            return
+        with self.pool.transaction() as own:
+            own.execute("DELETE FROM used_nonces WHERE nonce = ?", (nonce,))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "sweepSeconds": self.sweep_seconds}
+
+
+def make_nonce_store(backend: str) -> NonceStore:
+    if backend == "memory":
+        return MemoryNonceStore(CFG.nonce_window_seconds)
+    if backend == "sqlite":
+        return SQLiteNonceStore(CFG.nonce_window_seconds, GAMES_POOL)
+    raise RuntimeError(f"NONCE_BACKEND must be memory or sqlite (got {backend!r})")
+
+
+def server_worker_count() -> int:
+    """Worker processes gunicorn was asked for (argv, GUNICORN_CMD_ARGS, WEB_CONCURRENCY); 1 otherwise."""
+    args: List[str] = []
+    if "gunicorn" in os.path.basename(sys.argv[0] if sys.argv else ""):
+        args += sys.argv[1:]
+    args += shlex.split(os.environ.get("GUNICORN_CMD_ARGS", ""))
+    workers = safe_int(os.environ.get("WEB_CONCURRENCY"), 1)
+    for i, arg in enumerate(args):
+        if arg in ("-w", "--workers") and i + 1 < len(args):
+            workers = safe_int(args[i + 1], workers)
+        elif arg.startswith("--workers="):
+            workers = safe_int(arg.split("=", 1)[1], workers)
+        elif arg.startswith("-w") and arg[2:].isdigit():
+            workers = int(arg[2:])
+    return workers
+
+
+NONCE_STORE = make_nonce_store(CFG.nonce_backend)
+if not HASH_WORKER and isinstance(NONCE_STORE, MemoryNonceStore) and server_worker_count() > 1:
+    logger.warning(json.dumps({
+        "event": "nonce_store_per_process",
+        "workers": server_worker_count(),
+        "message": "NONCE_BACKEND=memory is per worker: a submit token can be replayed once per worker; set NONCE_BACKEND=sqlite",
+    }, separators=(",", ":")))
+
+
+class SubmitRejected(Exception):
+    """Raised inside the submission transaction to roll it back and reply with an error."""
+
+    def __init__(self, http_status: int, message: str, event: str, **log_fields: Any) -> None:
+        super().__init__(message)
+        self.http_status = http_status
+        self.message = message
+        self.event = event
+        self.log_fields = log_fields
+
+
+def write_submission(conn: sqlite3.Connection, nonce: str, cid: str, email: str,
+                     nickname: str, game: Dict[str, Any]) -> Tuple[int, bool]:
+    """
+    All writes for one score submission: nonce claim, email-ownership check +
+    users refresh, games insert + user_best upsert. Run it inside
+    GAMES_POOL.transaction() so the three commit together; raises
+    SubmitRejected (rolling everything back) when the submission is refused.
+    """
+    accept_submission(conn, nonce, cid, email, nickname)
+    return record_game(conn, game)
+
+
+def accept_submission(conn: sqlite3.Connection, nonce: str, cid: str, email: str, nickname: str,
+                      refresh_user: bool = True) -> None:
+    """
+    The nonce + ownership half of write_submission(), without the game insert.
+    If this raises after claiming the nonce, the claim is released; callers
+    that fail later (e.g. on commit) must call NONCE_STORE.release() themselves.
+    refresh_user=False leaves the users nickname/last_seen update to the
+    GameWriter batch (refresh_submitters), so with the memory nonce store this
+    only reads.
+    """
+    # Replay protection
+    if not NONCE_STORE.claim(nonce, conn):
+        raise SubmitRejected(409, "replay blocked", "replay_blocked")
+
+    try:
+        # Ensure the submitting client owns this email (if provided)
+        if email:
+            row = conn.execute("SELECT client_id FROM users WHERE email = ?", (email,)).fetchone()
+            if row is None:
+                raise SubmitRejected(401, "unregistered email", "unregistered_email")
+            owner = (row["client_id"] or "")
+            if owner and owner != cid:
+                raise SubmitRejected(403, "email already registered by another profile",
+                                     "email_not_owned", email=email, cid=cid)
+            # Keep latest nickname + last_seen
+            if refresh_user:
+                conn.execute("UPDATE users SET nickname = ?, last_seen = ? WHERE email = ?", (nickname, now_ms(), email))
+    except BaseException:
+        NONCE_STORE.release(nonce, conn)
+        raise
+
+
+def refresh_submitters(conn: sqlite3.Connection, games: List[Dict[str, Any]]) -> None:
+    """The users nickname/last_seen refresh for a write-behind batch; the latest game per email wins."""
+    conn.executemany(
+        "UPDATE users SET nickname = ?, last_seen = ? WHERE email = ?",
+        [(game["nickname"], game["created_at"], game["email"]) for game in games if game.get("email")],
+    )
+
+
+# ---------------------------------------------------------------------------
+# Write-behind queue for game inserts (LEADERBOARD_WRITE_MODE=enqueue|flush)
+# ---------------------------------------------------------------------------
+
+class _PendingGame:
+    __slots__ = ("game", "done", "error", "taken", "cancelled")
+
+    def __init__(self, game: Dict[str, Any], wait: bool) -> None:
+        self.game = game
+        self.done = threading.Event() if wait else None
+        self.error: Optional[BaseException] = None
+        self.taken = False      # picked up by a flush; can no longer be cancelled
+        self.cancelled = False
+
+
+class GameWriter:
+    """
+    Single writer thread that drains validated games from an in-process queue
+    and commits them in batches (every `batch_size` rows or `flush_interval_ms`,
+    whichever comes first), so concurrent requests stop queueing on SQLite's
+    writer lock. submit(wait=True) blocks until the batch holding the game has
+    committed ("flush" mode); wait=False acknowledges on enqueue ("enqueue"
+    mode — a crash loses whatever is still queued). A flush-mode submit that
+    times out before a flush picked the game up cancels it, so a timeout
+    always means "not written". Each batch also carries the submitters'
+    users refresh. stop() drains the queue.
+    """
+
+    _STOP = object()
+
+    def __init__(self, pool: SQLitePool, batch_size: int, flush_interval_ms: int) -> None:
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(1, flush_interval_ms) / 1000.0
+        self._start_lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self._take_lock = threading.Lock()
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def _ensure_started(self) -> None:
+        # Started lazily so a preloading (forking) server starts it in each worker
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._start_lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name="game-writer", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def submit(self, game: Dict[str, Any], wait: bool, timeout: float = 10.0) -> None:
+        self._ensure_started()
+        item = _PendingGame(game, wait)
+        self._queue.put(item)
+        with self._stats_lock:
+            self.enqueued += 1
+        if item.done is not None:
+            if not item.done.wait(timeout):
+                with self._take_lock:
+                    if not item.taken:
+                        item.cancelled = True  # never written; the caller may retry
+                        raise TimeoutError("game write not flushed in time")
+                # Already inside a flush transaction: its outcome is what counts
+                item.done.wait()
+            if item.error is not None:
+                raise item.error
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush everything still queued and stop the writer thread."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is self._STOP:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # Drain whatever arrived after the stop marker
+        rest = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                rest.append(item)
+        for i in range(0, len(rest), self.batch_size):
+            self._flush(rest[i:i + self.batch_size])
+
+    def _flush(self, batch: List[_PendingGame]) -> None:
+        with self._take_lock:
+            batch = [p for p in batch if not p.cancelled]
+            for p in batch:
+                p.taken = True
+        if not batch:
+            return
+        t0 = time.perf_counter()
+        error: Optional[BaseException] = None
+        changed = 0
+        try:
+            with self.pool.transaction() as conn:
+                games = [p.game for p in batch]
+                changed = record_games(conn, games)
+                refresh_submitters(conn, games)
+        except Exception as e:
+            error = e
+            log_json("write_behind_flush_failed", rows=len(batch), type=type(e).__name__, message=str(e))
+        dur_ms = (time.perf_counter() - t0) * 1000.0
+        with self._stats_lock:
+            self.batches += 1
+            if error is None:
+                self.flushed += len(batch)
+            else:
+                self.failed += len(batch)
+            self.last_flush_ms = dur_ms
+            self.max_flush_ms = max(self.max_flush_ms, dur_ms)
+            self.total_flush_ms += dur_ms
+        if changed:
+            LEADERBOARD_CACHE.invalidate()
+        for p in batch:
+            p.error = error
+            if p.done is not None:
+                p.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "mode": CFG.write_mode,
+                "queueDepth": self._queue.qsize(),
+                "enqueued": self.enqueued,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "batches": self.batches,
+                "lastFlushMs": round(self.last_flush_ms, 3),
+                "maxFlushMs": round(self.max_flush_ms, 3),
+                "avgFlushMs": round(self.total_flush_ms / self.batches, 3) if self.batches else None,
+            }
+
+
+GAME_WRITER: Optional[GameWriter] = None
+if CFG.write_mode != "sync":
+    GAME_WRITER = GameWriter(GAMES_POOL, CFG.write_batch_size, CFG.write_flush_interval_ms)
+    atexit.register(GAME_WRITER.stop)
 
 # ---------------------------------------------------------------------------
 # Request / Response logging
@@ -930,8 +2959,7 @@ def submit_token():
 
     # Enforce: one account per email (owned by first client_id that claims it)
     if email:
-        conn = get_db()
-        try:
+        with get_db() as conn:
             row = conn.execute("SELECT client_id FROM users WHERE email = ?", (email,)).fetchone()
             if row is None:
                 # First claim: create user bound to this client
@@ -952,8 +2980,6 @@ def submit_token():
                 # same device/profile: just refresh last_seen
                 conn.execute("UPDATE users SET last_seen = ? WHERE email = ?", (now_ms(), email))
                 conn.commit()
-        finally:
-            conn.close()
 
     emh = sha256_hex(email) if email else ""
     ua  = (request.headers.get("User-Agent") or "")[:200]
@@ -995,11 +3021,6 @@ def submit_result_public():
         log_json("token_verify_failed", request_id=g.request_id)
         return jsonify({"status": "error", "message": "bad or expired token"}), 401
 
-    # Replay protection
-    if nonce_used(vt.get("n", "")):
-        log_json("replay_blocked", request_id=g.request_id)
-        return jsonify({"status": "error", "message": "replay blocked"}), 409
-
     # Optional UA/IP check
     if CFG.bind_to_ua and vt.get("ua"):
         req_ua = (request.headers.get("User-Agent") or "")[:200]
@@ -1023,23 +3044,6 @@ def submit_result_public():
         log_json("email_hash_mismatch", request_id=g.request_id)
         return jsonify({"status": "error", "message": "email mismatch"}), 400
 
-    # NEW: ensure the submitting client owns this email (if provided)
-    if email:
-        conn = get_db()
-        try:
-            row = conn.execute("SELECT client_id FROM users WHERE email = ?", (email,)).fetchone()
-            if row is None:
-                return jsonify({"status": "error", "message": "unregistered email"}), 401
-            owner = (row["client_id"] or "")
-            if owner and owner != cid:
-                log_json("email_not_owned", request_id=g.request_id, email=email, cid=cid)
-                return jsonify({"status":"error","message":"email already registered by another profile"}), 403
-            # Keep latest nickname + last_seen
-            conn.execute("UPDATE users SET nickname = ?, last_seen = ? WHERE email = ?", (nickname, now_ms(), email))
-            conn.commit()
-        finally:
-            conn.close()
-
     hits_made   = safe_int(data.get("hitsMade"), 0)
     target      = safe_int(data.get("target"), 0)
     avg_prec    = safe_int(data.get("avgPrecision"), 0)
@@ -1059,29 +3063,61 @@ def submit_result_public():
 
     ukey = stable_key(email or None, cid or None)
 
-    # DB write
-    conn = get_db()
+    game = {
+        "user_key":      ukey,
+        "nickname":      nickname,
+        "email":         (email or None),
+        "hits_made":     hits_made,
+        "target":        target,
+        "avg_precision": avg_prec,
+        "outcome":       outcome,
+        "duration_ms":   duration_ms,
+        "created_at":    now_ms(),
+    }
+    # DB write: nonce, users and games in one BEGIN IMMEDIATE transaction,
+    # or — in write-behind mode — nonce + users now and the game via GAME_WRITER
+    nonce = vt.get("n", "")
+    improved = accepted = False
     try:
-        conn.execute(
-            """
-            INSERT INTO games (user_key, nickname, email, hits_made, target, avg_precision, outcome, duration_ms, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                ukey,
-                nickname,
-                (email or None),
-                hits_made,
-                target,
-                avg_prec,
-                outcome,
-                duration_ms,
-                now_ms(),
-            ),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+        if GAME_WRITER is None:
+            with GAMES_POOL.transaction() as conn:
+                accept_submission(conn, nonce, cid, email, nickname)
+                accepted = True
+                game_id, improved = record_game(conn, game)
+        elif NONCE_STORE.needs_conn:
+            # The sqlite nonce claim is a write; the users refresh rides in the writer's batch
+            with GAMES_POOL.transaction() as conn:
+                accept_submission(conn, nonce, cid, email, nickname, refresh_user=False)
+                accepted = True
+        else:
+            # Memory nonce claim + read-only ownership check: no write lock taken here
+            with GAMES_POOL.connection() as conn:
+                accept_submission(conn, nonce, cid, email, nickname, refresh_user=False)
+                accepted = True
+    except SubmitRejected as rej:
+        log_json(rej.event, request_id=g.request_id, **rej.log_fields)
+        return jsonify({"status": "error", "message": rej.message}), rej.http_status
+    except BaseException:
+        if accepted:
+            NONCE_STORE.release(nonce)
+        raise
+
+    if GAME_WRITER is not None:
+        try:
+            GAME_WRITER.submit(game, wait=(CFG.write_mode == "flush"))
+        except Exception as e:
+            # Flush failed or timed out before the game was taken: nothing was
+            # written, so give the token back and let the client retry it
+            NONCE_STORE.release(nonce)
+            log_json("submit_write_failed", request_id=g.request_id, type=type(e).__name__, message=str(e))
+            return jsonify({"status": "error", "message": "busy, retry"}), 503, {"Retry-After": "1"}
+
+    # Only a new personal best that lands inside the largest servable
+    # page can change a cached leaderboard response.
+    if improved:
+        with get_db() as conn:
+            if RANK_INDEX.rank_of(conn, {**game, "game_id": game_id}) <= LEADERBOARD_MAX_LIMIT:
+                LEADERBOARD_CACHE.invalidate()
 
     log_json(
         "submit_ok",
@@ -1100,43 +3136,53 @@ def submit_result_public():
 
 @app.route("/api/leaderboard", methods=["GET"])
 def leaderboard_public():
-    limit = max(1, min(safe_int(request.args.get("limit", 50), 50), 200))
-    conn = get_db()
-    try:
-        rows = conn.execute(
-            """
-            WITH ranked AS (
-              SELECT
-                id, user_key, nickname, email, hits_made, target, avg_precision, outcome, duration_ms, created_at,
-                ROW_NUMBER() OVER (
-                  PARTITION BY user_key
-                  ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
-                ) AS rn
-              FROM games
-            )
-            SELECT nickname, hits_made, target, avg_precision, outcome, duration_ms, created_at
-            FROM ranked
-            WHERE rn = 1
-            ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
-            LIMIT ?
-            """,
-            (limit,),
-        ).fetchall()
-    finally:
-        conn.close()
-
-    items = [{
-        "nickname":     (r["nickname"] or "Player"),
-        "hitsMade":     int(r["hits_made"]),
-        "target":       int(r["target"]),
-        "avgPrecision": int(r["avg_precision"]),
-        "outcome":      r["outcome"],
-        "durationMs":   (int(r["duration_ms"]) if r["duration_ms"] is not None else None),
-        "date":         int(r["created_at"]),
-        "rank":         i + 1,
-    } for i, r in enumerate(rows)]
-
-    return jsonify({"status": "ok", "items": items})
+    limit = max(1, min(safe_int(request.args.get("limit", 50), 50), LEADERBOARD_MAX_LIMIT))
+
+    entry = LEADERBOARD_CACHE.get(limit)
+    if entry is None:
+        with get_db() as conn:
+            # Top-N straight off idx_user_best_rank; cost is independent of games history
+            rows = conn.execute(
+                """
+                SELECT nickname, hits_made, target, avg_precision, outcome, duration_ms, created_at
+                FROM user_best
+                ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
+                LIMIT ?
+                """,
+                (limit,),
+            ).fetchall()
+
+        items = [{
+            "nickname":     (r["nickname"] or "Player"),
+            "hitsMade":     int(r["hits_made"]),
+            "target":       int(r["target"]),
+            "avgPrecision": int(r["avg_precision"]),
+            "outcome":      r["outcome"],
+            "durationMs":   (int(r["duration_ms"]) if r["duration_ms"] is not None else None),
+            "date":         int(r["created_at"]),
+            "rank":         i + 1,
+        } for i, r in enumerate(rows)]
+
+        entry = LEADERBOARD_CACHE.put(limit, app.json.dumps({"status": "ok", "items": items}))
+
+    resp = app.response_class(entry.body, mimetype="application/json")
+    resp.set_etag(entry.etag)
+    resp.headers["Cache-Control"] = "no-cache"  # always revalidate; 304 when unchanged
+    return resp.make_conditional(request)
+
+
+
+@app.route("/api/leaderboard/stats", methods=["GET"])
+def leaderboard_stats():
+    """Per-worker cache and write-behind counters, for tuning LEADERBOARD_CACHE_TTL / _WRITE_*."""
+    return jsonify({
+        "status": "ok",
+        "pid": os.getpid(),
+        "cache": LEADERBOARD_CACHE.stats(),
+        "rankIndexSize": len(RANK_INDEX),
+        "writer": (GAME_WRITER.stats() if GAME_WRITER is not None else {"mode": "sync"}),
+        "nonces": NONCE_STORE.stats(),
+    })
 
 
 
@@ -1158,39 +3204,18 @@ def leaderboard_me():
     if not ukey:
         return jsonify({"status": "error", "message": "invalid identifiers"}), 400
 
-    conn = get_db()
-    try:
-        # 1) Best score per user (rn=1)
-        # 2) Rank all best scores globally
+    with get_db() as conn:
+        # 1) Best score per user: primary-key probe on user_best
+        # 2) Global rank: bisect in RANK_INDEX (synced from user_best first)
         row = conn.execute(
             """
-            WITH per_user_best AS (
-              SELECT
-                id, user_key, nickname, email, hits_made, target, avg_precision, outcome, duration_ms, created_at,
-                ROW_NUMBER() OVER (
-                  PARTITION BY user_key
-                  ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
-                ) AS rn
-              FROM games
-            ),
-            ranked AS (
-              SELECT
-                user_key, nickname, email, hits_made, target, avg_precision, outcome, duration_ms, created_at,
-                ROW_NUMBER() OVER (
-                  ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
-                ) AS rnk
-              FROM per_user_best
-              WHERE rn = 1
-            )
-            SELECT
-              nickname, email, hits_made, target, avg_precision, outcome, duration_ms, created_at, rnk
-            FROM ranked
+            SELECT game_id, nickname, email, hits_made, target, avg_precision, outcome, duration_ms, created_at
+            FROM user_best
             WHERE user_key = ?
             """,
             (ukey,),
         ).fetchone()
-    finally:
-        conn.close()
+        rank = RANK_INDEX.rank_of(conn, row) if row else None
 
     if not row:
         # Not ranked yet (no games for this user_key)
@@ -1205,7 +3230,7 @@ def leaderboard_me():
         "outcome":      row["outcome"],
         "durationMs":   (int(row["duration_ms"]) if row["duration_ms"] is not None else None),
         "date":         int(row["created_at"]),
-        "rank":         int(row["rnk"]),
+        "rank":         rank,
     }
     return jsonify({"status": "ok", "item": item})
 
@@ -1218,6 +3243,337 @@ def leaderboard_me():
 
 
 
+# ====== HISTORY SEARCH INDEX (sidecar DB) ====================================
+#
+# The History file is a copied Chrome database, so we never write to it.
+# Search structures and rollups live in a separate sidecar DB that is ATTACHed
+# to every pooled History connection as `hidx`. Opt in with HISTORY_FTS=1.
+
+HISTORY_INDEX_DB = os.environ.get("HISTORY_INDEX_DB_PATH") or rel_path("history_index.db")
+HISTORY_FTS_ENABLED = os.environ.get("HISTORY_FTS", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def normalize_host(url: str) -> str:
+    """Lowercased host of a URL (or a bare domain), without a leading `www.`; '' if none."""
+    if "//" not in url:
+        url = "//" + url
+    try:
+        host = urllib.parse.urlsplit(url).hostname or ""
+    except ValueError:
+        return ""
+    return host[4:] if host.startswith("www.") else host
+
+
+def reverse_host(host: str) -> str:
+    """`sub.example.com` -> `com.example.sub`: subdomains of a host share its prefix."""
+    return ".".join(reversed(host.split(".")))
+
+
+class HistoryIndex:
+    """
+    FTS5 (trigram) index over urls.title, urls.url and keyword_search_terms.term,
+    one row per urls.id (terms joined with spaces). Trigram tokens make MATCH a
+    substring search over the whole url, so it is a prefilter: it yields every
+    url the `LIKE '%q%'` filters could match, plus some whose match lies in
+    another of the url's terms or spans two of them. history() keeps the LIKE
+    on the joined rows to drop those. Queries with LIKE wildcards (`%`, `_`)
+    are not literal substrings and bypass the index.
+
+    refresh() is incremental: it remembers the highest urls.id and visits.id it
+    has indexed, adds newer urls, and re-indexes urls that got new visits
+    (Chrome updates titles and search terms on revisit). If the ids go
+    backwards a different History file was deployed and the index is rebuilt.
+
+    The same pass parses each url's host once into `url_host` (keyed by the
+    reversed host, so a domain and its subdomains are one index range) and
+    folds new visits into two rollups: visits per host, and visits per
+    (UTC day, core transition type).
+
+    `ready` holds only while the History file on disk is the snapshot this
+    process last indexed (same mtime, size and inode), so url ids from an
+    old snapshot are never applied to a newly deployed one mid-rebuild.
+    """
+
+    BATCH = 5000
+    SCHEMA_VERSION = 2  # bump to force a full rebuild of an existing sidecar
+
+    def __init__(self, history_path: str, index_path: str) -> None:
+        self.history_path = history_path
+        self.index_path = index_path
+        self._indexed_signature: Optional[Tuple[int, int, int]] = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._checked_mtime: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        indexed = self._indexed_signature
+        return indexed is not None and indexed == SnapshotPool._signature(self.history_path)
+
+    def _open_index(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.index_path)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA busy_timeout=5000;")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS url_fts USING fts5(title, url, terms, tokenize='trigram')")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS url_host (
+                url_id INTEGER PRIMARY KEY,
+                host   TEXT NOT NULL,
+                rhost  TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_url_host_rhost ON url_host (rhost, url_id)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_host (
+                host   TEXT PRIMARY KEY,
+                visits INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rollup_host_visits ON rollup_host (visits DESC)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_day (
+                day        TEXT    NOT NULL,   -- YYYY-MM-DD, UTC
+                transition INTEGER NOT NULL,   -- visits.transition & 0xff
+                visits     INTEGER NOT NULL,
+                PRIMARY KEY (day, transition)
+            ) WITHOUT ROWID
+        """)
+        conn.commit()
+        return conn
+
+    def _open_history(self) -> sqlite3.Connection:
+        return sqlite3.connect(sqlite_readonly_uri(self.history_path), uri=True)
+
+    @staticmethod
+    def _meta(conn: sqlite3.Connection, key: str) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _index_urls(self, src: sqlite3.Connection, dst: sqlite3.Connection, where: str, params: Tuple[Any, ...]) -> int:
+        cur = src.execute(
+            f"""
+            SELECT u.id, COALESCE(u.title, ''), COALESCE(u.url, ''),
+                   COALESCE((SELECT group_concat(k.term, ' ') FROM keyword_search_terms k WHERE k.url_id = u.id), '')
+            FROM urls u
+            WHERE {where}
+            """,
+            params,
+        )
+        n = 0
+        while True:
+            rows = cur.fetchmany(self.BATCH)
+            if not rows:
+                return n
+            dst.executemany("DELETE FROM url_fts WHERE rowid = ?", [(r[0],) for r in rows])
+            dst.executemany("INSERT INTO url_fts (rowid, title, url, terms) VALUES (?, ?, ?, ?)", rows)
+            n += len(rows)
+
+    def _index_hosts(self, src: sqlite3.Connection, dst: sqlite3.Connection, last_url: int) -> int:
+        cur = src.execute("SELECT id, COALESCE(url, '') FROM urls WHERE id > ?", (last_url,))
+        n = 0
+        while True:
+            rows = cur.fetchmany(self.BATCH)
+            if not rows:
+                return n
+            hosts = [(url_id, normalize_host(url)) for url_id, url in rows]
+            dst.executemany(
+                "INSERT OR REPLACE INTO url_host (url_id, host, rhost) VALUES (?, ?, ?)",
+                [(url_id, host, reverse_host(host)) for url_id, host in hosts],
+            )
+            n += len(rows)
+
+    def _roll_up_visits(self, src: sqlite3.Connection, dst: sqlite3.Connection, last_visit: int) -> int:
+        # Pre-aggregate per (url, day, transition) on the History side, then let
+        # the sidecar map urls to hosts and add the counts onto the rollups.
+        cur = src.execute(
+            """
+            SELECT v.url, date(v.visit_time / 1000000 - 11644473600, 'unixepoch'), v.transition & 0xff, COUNT(*)
+            FROM visits v
+            WHERE v.id > ?
+            GROUP BY 1, 2, 3
+            """,
+            (last_visit,),
+        )
+        dst.execute("CREATE TEMP TABLE IF NOT EXISTS visit_stage (url_id INTEGER, day TEXT, transition INTEGER, n INTEGER)")
+        dst.execute("DELETE FROM visit_stage")
+        n = 0
+        while True:
+            rows = cur.fetchmany(self.BATCH)
+            if not rows:
+                break
+            dst.executemany("INSERT INTO visit_stage VALUES (?, ?, ?, ?)", rows)
+            n += sum(r[3] for r in rows)
+        dst.execute("""
+            INSERT INTO rollup_host (host, visits)
+            SELECT h.host, SUM(s.n) FROM visit_stage s JOIN url_host h ON h.url_id = s.url_id
+            WHERE h.host != ''
+            GROUP BY h.host
+            ON CONFLICT(host) DO UPDATE SET visits = visits + excluded.visits
+        """)
+        dst.execute("""
+            INSERT INTO rollup_day (day, transition, visits)
+            SELECT day, transition, SUM(n) FROM visit_stage
+            WHERE day IS NOT NULL
+            GROUP BY day, transition
+            ON CONFLICT(day, transition) DO UPDATE SET visits = visits + excluded.visits
+        """)
+        dst.execute("DELETE FROM visit_stage")
+        return n
+
+    def refresh(self) -> Dict[str, int]:
+        """Bring the sidecar up to date with the History file."""
+        signature = SnapshotPool._signature(self.history_path)  # before opening, as SnapshotPool does
+        src = self._open_history()
+        dst = self._open_index()
+        try:
+            max_url = src.execute("SELECT COALESCE(MAX(id), 0) FROM urls").fetchone()[0]
+            max_visit = src.execute("SELECT COALESCE(MAX(id), 0) FROM visits").fetchone()[0]
+
+            dst.execute("BEGIN IMMEDIATE")
+            last_url = self._meta(dst, "max_url_id")
+            last_visit = self._meta(dst, "max_visit_id")
+            if (max_url < last_url or max_visit < last_visit
+                    or self._meta(dst, "schema_version") != self.SCHEMA_VERSION):
+                for table in ("url_fts", "url_host", "rollup_host", "rollup_day"):
+                    dst.execute(f"DELETE FROM {table}")
+                last_url = last_visit = 0
+
+            added = self._index_urls(src, dst, "u.id > ?", (last_url,))
+            touched = 0
+            if last_visit:
+                touched = self._index_urls(
+                    src, dst,
+                    "u.id <= ? AND u.id IN (SELECT url FROM visits WHERE id > ?)",
+                    (last_url, last_visit),
+                )
+            hosts = self._index_hosts(src, dst, last_url)
+            visits = self._roll_up_visits(src, dst, last_visit)
+            dst.executemany(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [("max_url_id", max_url), ("max_visit_id", max_visit), ("schema_version", self.SCHEMA_VERSION)],
+            )
+            dst.commit()
+            # A snapshot swapped in while this ran stays not-ready until the next refresh
+            self._indexed_signature = signature
+            return {"added": added, "reindexed": touched, "hosts": hosts, "visits_rolled_up": visits,
+                    "max_url_id": max_url, "max_visit_id": max_visit}
+        finally:
+            src.close()
+            dst.close()
+
+    def _refresh_in_background(self) -> None:
+        try:
+            stats = self.refresh()
+            log_json("history_index_refreshed", **stats)
+        except Exception as e:
+            log_json("history_index_refresh_failed", type=type(e).__name__, message=str(e))
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def ensure_fresh(self) -> None:
+        """
+        Cheap per-request check: when the History file's mtime moves, refresh
+        in a background thread. Queries keep using the LIKE fallback until the
+        first build has finished.
+        """
+        try:
+            mtime = os.path.getmtime(self.history_path)
+        except OSError:
+            return
+        with self._lock:
+            if self._refreshing or mtime == self._checked_mtime:
+                return
+            self._checked_mtime = mtime
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, name="history-index", daemon=True).start()
+
+    @staticmethod
+    def phrase(text: str) -> str:
+        """Quote user input as a single FTS5 phrase."""
+        return '"' + text.replace('"', '""') + '"'
+
+
+HISTORY_INDEX = HistoryIndex(HISTORY_DB, HISTORY_INDEX_DB) if HISTORY_FTS_ENABLED else None
+
+
+def attach_history_index(conn: sqlite3.Connection) -> None:
+    if HISTORY_INDEX is not None:
+        conn.execute("ATTACH DATABASE ? AS hidx", (HISTORY_INDEX.index_path,))
+
+
+def history_sidecar_ready() -> bool:
+    if HISTORY_INDEX is None:
+        return False
+    HISTORY_INDEX.ensure_fresh()
+    return HISTORY_INDEX.ready
+
+
+def history_index_ready(text: str) -> bool:
+    """
+    The trigram index can only answer literal substrings of 3+ characters.
+    The LIKE it prefilters for treats `%` and `_` as wildcards, so queries
+    containing either skip the index rather than lose those matches.
+    """
+    return history_sidecar_ready() and len(text) >= 3 and '%' not in text and '_' not in text
+
+
+# Core transition types (visits.transition & 0xff), as named by Chrome
+HISTORY_TRANSITIONS = {
+    0: "link", 1: "typed", 2: "auto_bookmark", 3: "auto_subframe", 4: "manual_subframe",
+    5: "generated", 6: "auto_toplevel", 7: "form_submit", 8: "reload", 9: "keyword",
+    10: "keyword_generated",
+}
+
+
+@app.route("/api/history/rollups", methods=["GET"])
+def history_rollups():
+    """
+    Top domains and activity per day / transition type, straight from the
+    sidecar rollups (no scan of visits).
+      /api/history/rollups?top=20&date_from=2024-01-01&date_to=2024-01-31
+    """
+    if not history_sidecar_ready():
+        return jsonify({"status": "error", "message": "History index is not built (HISTORY_FTS=1)"}), 503
+
+    top = max(1, min(request.args.get("top", 20, type=int), 500))
+    date_from = request.args.get("date_from", "") or "0000-00-00"
+    date_to = request.args.get("date_to", "") or "9999-99-99"
+
+    with get_history_db() as conn:
+        domains = conn.execute(
+            "SELECT host, visits FROM hidx.rollup_host ORDER BY visits DESC LIMIT ?", (top,)
+        ).fetchall()
+        days = conn.execute(
+            "SELECT day, SUM(visits) AS visits FROM hidx.rollup_day WHERE day BETWEEN ? AND ? GROUP BY day ORDER BY day",
+            (date_from, date_to),
+        ).fetchall()
+        transitions = conn.execute(
+            "SELECT transition, SUM(visits) AS visits FROM hidx.rollup_day WHERE day BETWEEN ? AND ? GROUP BY transition ORDER BY visits DESC",
+            (date_from, date_to),
+        ).fetchall()
+
+    return jsonify({
+        "status": "ok",
+        "topDomains": [{"host": r["host"], "visits": r["visits"]} for r in domains],
+        "byDay": [{"day": r["day"], "visits": r["visits"]} for r in days],
+        "byTransition": [
+            {"transition": HISTORY_TRANSITIONS.get(r["transition"], str(r["transition"])), "visits": r["visits"]}
+            for r in transitions
+        ],
+    })
+
+
+@app.cli.command("refresh-history-index")
+def refresh_history_index_command():
+    """Build or incrementally refresh the History search sidecar."""
+    stats = HistoryIndex(HISTORY_DB, HISTORY_INDEX_DB).refresh()
+    print(f"history index refreshed: {stats}")
+
+
+
+
 ##
 # Users db
 #
@@ -1232,14 +3588,13 @@ from email.mime.text import MIMEText
 # USERS DB
 from flask import jsonify, request, session
 from werkzeug.security import generate_password_hash, check_password_hash
-import base64, smtplib, sqlite3, uuid, json
+import base64, smtplib, sqlite3, uuid, json, random
 from email.mime.text import MIMEText
 
-def init_user_db():
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
+USERS_MIGRATIONS = [
+    # 1: baseline
+    (
+        """CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             nickname TEXT NOT NULL,
             email TEXT NOT NULL UNIQUE,
@@ -1248,12 +3603,471 @@ def init_user_db():
             profile_image TEXT,
             verification_token TEXT,
             is_verified INTEGER DEFAULT 0
+        )""",
+    ),
+    # 2: avatar blob store
+    (add_column_if_missing('users', 'avatar_hash', 'TEXT'),),
+    # 3: mail queued for the background sender (see EmailOutbox)
+    (
+        """CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_addr TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',   -- pending | sent | failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,          -- ms; also the claim lease while sending
+            last_error TEXT,
+            created_at INTEGER NOT NULL,
+            sent_at INTEGER
+        )""",
+        """CREATE INDEX IF NOT EXISTS idx_email_outbox_due
+            ON email_outbox(next_attempt_at) WHERE status = 'pending'""",
+    ),
+    # 4: verify_email() looks rows up by verification_token
+    (
+        """CREATE INDEX IF NOT EXISTS idx_users_verification_token
+            ON users (verification_token) WHERE verification_token IS NOT NULL""",
+    ),
+]
+
+def init_user_db(db_path=None):
+    migrate(db_path or USERS_DB, USERS_MIGRATIONS)
+
+if not HASH_WORKER:
+    init_user_db()
+
+
+# ------------------
+# Avatar blob store
+# ------------------
+AVATAR_FOLDER = os.path.join(app.static_folder, 'avatars')
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_MAX_BYTES = 8 * 1024 * 1024  # decoded upload
+
+
+class AvatarStore:
+    """
+    Profile images as files named by the sha256 of the uploaded bytes:
+    `<hash>-<size>.webp` for each of AVATAR_SIZES, square-cropped, EXIF
+    orientation applied, no metadata. The users row keeps only the hash; the
+    same picture uploaded twice is stored once. Files never change under a
+    name, so their URLs are served as immutable.
+    """
+
+    def __init__(self, folder, sizes=AVATAR_SIZES):
+        self.folder = folder
+        self.sizes = sizes
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def decode_data_url(data_url):
+        """Bytes of a `data:image/...;base64,` URL; ValueError if it isn't one."""
+        header, sep, payload = (data_url or '').partition(',')
+        if not sep or not header.startswith('data:image/') or not header.endswith(';base64'):
+            raise ValueError('Profile image must be a base64 image data URL')
+        if len(payload) > AVATAR_MAX_BYTES * 4 // 3 + 4:
+            raise ValueError('Profile image is too large')
+        return base64.b64decode(payload, validate=True)
+
+    def name(self, key, size):
+        return f"{key}-{size}.webp"
+
+    def save(self, raw):
+        """Write every size of an image (bytes) and return its hash."""
+        if Image is None:
+            raise ValueError('Profile images are not supported on this server')
+        key = hashlib.sha256(raw).hexdigest()
+        if all(os.path.exists(os.path.join(self.folder, self.name(key, size))) for size in self.sizes):
+            return key
+        try:
+            with Image.open(io.BytesIO(raw)) as src:
+                im = ImageOps.exif_transpose(src)
+                has_alpha = im.mode in ('RGBA', 'LA') or (im.mode == 'P' and 'transparency' in im.info)
+                im = im.convert('RGBA' if has_alpha else 'RGB')
+        except Exception:
+            raise ValueError('Profile image could not be decoded')
+        for size in sorted(self.sizes, reverse=True):
+            im = ImageOps.fit(im, (size, size), Image.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, 'WEBP', quality=85, method=4)
+            path = os.path.join(self.folder, self.name(key, size))
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(buf.getvalue())
+            os.replace(tmp, path)
+        return key
+
+    def urls(self, key):
+        """{size: url} for a stored avatar, or None without one."""
+        if not key:
+            return None
+        return {str(size): url_for('static', filename=AVATAR_STATIC_PREFIX + self.name(key, size)) for size in self.sizes}
+
+
+AVATARS = AvatarStore(AVATAR_FOLDER)
+
+
+def profile_image_fields(avatar_hash, legacy_image):
+    """`image` (largest avatar URL) and `avatar` (URL per size) for the profile JSON."""
+    avatar = AVATARS.urls(avatar_hash)
+    if avatar:
+        return {'image': avatar[str(max(AVATARS.sizes))], 'avatar': avatar}
+    return {'image': legacy_image, 'avatar': None}  # row not migrated yet
+
+
+@app.cli.command("migrate-profile-images")
+def migrate_profile_images_command():
+    """Move inline data-URL profile images from users.db into the avatar store."""
+    moved = failed = 0
+    with get_users_db() as conn:
+        rows = conn.execute(
+            "SELECT id, profile_image FROM users WHERE avatar_hash IS NULL AND profile_image LIKE 'data:image/%'"
+        ).fetchall()
+        for user_id, data_url in rows:
+            try:
+                key = AVATARS.save(AVATARS.decode_data_url(data_url))
+            except ValueError as e:
+                failed += 1
+                print(f"user {user_id}: {e}")
+                continue
+            conn.execute("UPDATE users SET avatar_hash = ?, profile_image = NULL WHERE id = ?", (key, user_id))
+            moved += 1
+        conn.commit()
+        if moved:
+            conn.execute("VACUUM")  # hand the freed TEXT pages back
+    print(f"profile images moved: {moved}, failed: {failed}")
+
+# ------------------
+# Email outbox
+# ------------------
+# Mail is queued in users.db in the same transaction as the row it belongs to
+# and delivered by a background thread, so a slow SMTP host never holds a
+# request worker.
+
+@dataclass(frozen=True)
+class SMTPConfig:
+    host: str = 'smtp.yourdomain.com'
+    port: int = 587
+    username: str = ''
+    password: str = ''
+    starttls: bool = True
+    sender: str = 'noreply@yourdomain.com'
+    timeout: float = 20.0
+
+
+SMTP_CFG = SMTPConfig(
+    host=os.environ.get('SMTP_HOST', 'smtp.yourdomain.com'),
+    port=int(os.environ.get('SMTP_PORT', '587')),
+    username=os.environ.get('SMTP_USER', ''),
+    password=os.environ.get('SMTP_PASSWORD', ''),
+    starttls=os.environ.get('SMTP_STARTTLS', '1') != '0',
+    sender=os.environ.get('MAIL_FROM', 'noreply@yourdomain.com'),
+)
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', 'http://localhost:1111').rstrip('/')
+
+
+class EmailOutbox:
+    """
+    Background sender for the email_outbox table.
+
+    Due rows are claimed in batches by pushing their next_attempt_at out by a
+    lease, so several worker processes can run a sender without sending twice
+    (a sender that dies mid-batch just lets the lease expire). A batch goes out
+    over one authenticated SMTP connection. Transient failures are retried
+    with exponential backoff and jitter; 5xx replies, or running out of
+    attempts, mark the row failed. Started lazily per process, like GameWriter;
+    with enabled=False rows are only queued (send them with send_due()).
+    """
+
+    def __init__(self, pool: SQLitePool, smtp: SMTPConfig, batch_size: int = 50,
+                 lease_seconds: float = 300.0, base_delay: float = 30.0,
+                 max_delay: float = 3600.0, max_attempts: int = 8,
+                 idle_poll: float = 30.0, enabled: bool = True) -> None:
+        self.pool = pool
+        self.enabled = enabled
+        self.smtp = smtp
+        self.batch_size = max(1, batch_size)
+        self.lease_ms = int(lease_seconds * 1000)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.idle_poll = idle_poll
+        self._start_lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._stopping = False
+
+    def enqueue(self, conn: sqlite3.Connection, to_addr: str, subject: str, body: str) -> int:
+        """Queue a message on `conn`; it is sent once the caller commits and calls wake()."""
+        ts = now_ms()
+        cur = conn.execute(
+            "INSERT INTO email_outbox (to_addr, subject, body, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (to_addr, subject, body, ts, ts),
         )
-    """)
-    conn.commit()
-    conn.close()
+        return cur.lastrowid
+
+    def ensure_started(self) -> None:
+        if not self.enabled or (self._pid == os.getpid() and self._thread is not None):
+            return
+        with self._start_lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._wake = threading.Event()
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def wake(self) -> None:
+        self.ensure_started()
+        if self._thread is not None:
+            self._wake.set()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                delay = self.send_due()
+            except Exception as e:
+                log_json("email_outbox_error", type=type(e).__name__, message=str(e))
+                delay = self.idle_poll
+            self._wake.wait(delay)
+
+    def send_due(self) -> float:
+        """Send everything that is due; returns seconds until the next row is."""
+        while not self._stopping:
+            batch = self._claim()
+            if not batch:
+                break
+            self._deliver(batch)
+        with self.pool.connection() as conn:
+            due = conn.execute("SELECT MIN(next_attempt_at) FROM email_outbox WHERE status = 'pending'").fetchone()[0]
+        if due is None:
+            return self.idle_poll
+        return min(self.idle_poll, max(0.05, (due - now_ms()) / 1000.0))
+
+    def _claim(self) -> List[sqlite3.Row]:
+        ts = now_ms()
+        with self.pool.transaction() as conn:
+            return conn.execute("""
+                UPDATE email_outbox SET next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM email_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at LIMIT ?
+                )
+                RETURNING id, to_addr, subject, body, attempts
+            """, (ts + self.lease_ms, ts, self.batch_size)).fetchall()
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.smtp.host, self.smtp.port, timeout=self.smtp.timeout)
+        try:
+            if self.smtp.starttls:
+                smtp.starttls()
+            if self.smtp.username:
+                smtp.login(self.smtp.username, self.smtp.password)
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    def _message(self, row: sqlite3.Row) -> MIMEText:
+        msg = MIMEText(row['body'])
+        msg['Subject'] = row['subject']
+        msg['From'] = self.smtp.sender
+        msg['To'] = row['to_addr']
+        return msg
+
+    @staticmethod
+    def _permanent(e: BaseException) -> bool:
+        if isinstance(e, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in e.recipients.values())
+        return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+
+    def _deliver(self, batch: List[sqlite3.Row]) -> None:
+        results: List[Tuple[sqlite3.Row, Optional[BaseException]]] = []
+        try:
+            smtp = self._connect()
+        except (smtplib.SMTPException, OSError) as e:
+            log_json("smtp_connect_failed", host=self.smtp.host, port=self.smtp.port,
+                     type=type(e).__name__, message=str(e))
+            self._record([(row, e) for row in batch], connect_error=True)
+            return
+        try:
+            for i, row in enumerate(batch):
+                try:
+                    smtp.send_message(self._message(row))
+                    results.append((row, None))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    results.append((row, e))  # this message only; the connection is still good
+                except (smtplib.SMTPException, OSError) as e:
+                    results.extend((r, e) for r in batch[i:])  # connection lost
+                    break
+        finally:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+            self._record(results)
+
+    def _backoff_ms(self, attempts: int) -> int:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return int(delay * random.uniform(0.5, 1.0) * 1000)
+
+    def _record(self, results: List[Tuple[sqlite3.Row, Optional[BaseException]]], connect_error: bool = False) -> None:
+        ts = now_ms()
+        with self.pool.transaction() as conn:
+            for row, error in results:
+                attempts = row['attempts'] + 1
+                if error is None:
+                    conn.execute(
+                        "UPDATE email_outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL WHERE id = ?",
+                        (attempts, ts, row['id']),
+                    )
+                    continue
+                message = f"{type(error).__name__}: {error}"
+                failed = attempts >= self.max_attempts or (not connect_error and self._permanent(error))
+                conn.execute(
+                    "UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    ('failed' if failed else 'pending', attempts, ts + self._backoff_ms(attempts), message, row['id']),
+                )
+                if failed:
+                    log_json("email_failed", outbox_id=row['id'], attempts=attempts, message=message)
+
+
+EMAIL_OUTBOX = EmailOutbox(USERS_POOL, SMTP_CFG, enabled=os.environ.get('EMAIL_OUTBOX_SENDER', '1') != '0')
+atexit.register(EMAIL_OUTBOX.stop)
+
+
+@app.before_request
+def _start_email_outbox():
+    # Also picks up mail left pending by a previous run
+    EMAIL_OUTBOX.ensure_started()
+
+
+@app.cli.command("send-emails")
+def send_emails_command():
+    """Deliver due outbox mail once, in the foreground."""
+    EMAIL_OUTBOX.send_due()
+    with get_users_db() as conn:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall())
+    print(f"outbox: {counts}")
+
+
+def queue_verification_email(conn, to_email, token):
+    link = f"{PUBLIC_BASE_URL}/verify_email?token={token}"
+    return EMAIL_OUTBOX.enqueue(conn, to_email, 'Verify your Helena Paint account',
+                                f"Click to verify your email:\n\n{link}")
+
+
+# ------------------
+# Session profile cache
+# ------------------
+
+class ProfileCache:
+    """
+    Per-process LRU of profile dicts by user id, shared by the request
+    threads. Profile writes in this process call bump(), which drops the
+    user's entry and advances a version counter; a fill that read the row
+    before a bump carries the old version and is discarded, so a stale row
+    can't be cached after the write. The TTL bounds how stale other workers
+    get, as with ResponseCache.
+    """
+
+    def __init__(self, max_size=4096, ttl_seconds=30.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (expires_at, profile)
+        self.version = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def put(self, user_id, profile, version):
+        with self._lock:
+            if version != self.version or self.max_size <= 0:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl_seconds, profile)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def bump(self, user_id=None):
+        """Forget one user (or everyone) after a write to their row."""
+        with self._lock:
+            self.version += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+PROFILE_CACHE = ProfileCache(
+    max_size=int(os.environ.get("PROFILE_CACHE_SIZE", "4096")),
+    ttl_seconds=float(os.environ.get("PROFILE_CACHE_TTL", "30")),
+)
+
+# Fields copied into the signed session cookie at login; `?fields=` asking
+# only for these (and loggedIn) is answered without touching users.db
+SESSION_PROFILE_FIELDS = ('nickname', 'email')
+
+
+def profile_from_row(nickname, email, bio, avatar_hash, legacy_image, is_verified):
+    return {
+        'nickname': nickname,
+        'email': email,
+        'bio': bio,
+        **profile_image_fields(avatar_hash, legacy_image),
+        'isVerified': bool(is_verified)
+    }
+
+
+def load_profile(user_id):
+    """Profile dict for a user id through PROFILE_CACHE; None if the user is gone."""
+    profile = PROFILE_CACHE.get(user_id)
+    if profile is not None:
+        return profile
+    version = PROFILE_CACHE.version
+    with get_users_db() as conn:
+        row = conn.execute("SELECT nickname, email, bio, avatar_hash, profile_image, is_verified FROM users WHERE id = ?", (user_id,)).fetchone()
+    if not row:
+        return None
+    profile = profile_from_row(*row)
+    PROFILE_CACHE.put(user_id, profile, version)
+    return profile
+
+
+def password_hasher_busy():
+    return jsonify({'status': 'error', 'message': 'Server busy, try again shortly'}), 503, {'Retry-After': '2'}
+
+
+def rehash_password(user_id, old_hash, password):
+    """Upgrade a hash made with old cost parameters; the password was just verified."""
+    new_hash = PASSWORD_HASHER.hash(password)
+    with get_users_db() as conn:
+        conn.execute("UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?", (new_hash, user_id, old_hash))
+        conn.commit()
+    log_json("password_rehashed", user_id=user_id, method=PASSWORD_HASHER.method)
 
-init_user_db()
 
 @app.route('/api/save_profile', methods=['POST'])
 def save_profile():
@@ -1264,30 +4078,53 @@ def save_profile():
         password = data.get('password', '').strip()
         bio = data.get('bio', '').strip()
         image_data = data.get('image')
-        print("[SAVE_PROFILE] Incoming:", json.dumps(data, indent=2))
+        print("[SAVE_PROFILE] Incoming:", json.dumps({k: v for k, v in data.items() if k not in ('image', 'password')}, indent=2))
 
         if not nickname or not email or not password:
             return jsonify({'status': 'error', 'message': 'Nickname, email, and password required'}), 400
 
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE email = ?", (email,))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({'status': 'error', 'message': 'Email already registered'}), 400
+        image_raw = None
+        if image_data:
+            try:
+                image_raw = AVATARS.decode_data_url(image_data)
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
 
-        token = str(uuid.uuid4())
-        password_hash = generate_password_hash(password)
+        with get_users_db() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone():
+                return jsonify({'status': 'error', 'message': 'Email already registered'}), 400
 
-        cursor.execute("""
-            INSERT INTO users (nickname, email, password_hash, bio, profile_image, verification_token)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (nickname, email, password_hash, bio, image_data, token))
-        conn.commit()
-        conn.close()
+        # Hash outside the connection block; the unique email index still
+        # catches a concurrent signup for the same address
+        try:
+            password_hash = PASSWORD_HASHER.hash(password)
+        except PasswordHasherBusy:
+            return password_hasher_busy()
+
+        # Written only once the signup is going ahead, so a rejected request
+        # leaves no files behind
+        avatar_hash = None
+        if image_raw is not None:
+            try:
+                avatar_hash = AVATARS.save(image_raw)
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
 
-        send_verification_email(email, token)
-        print(f"[SAVE_PROFILE] Created user {email}, sent token {token}")
+        token = str(uuid.uuid4())
+        try:
+            with get_users_db() as conn:
+                user_id = conn.execute("""
+                    INSERT INTO users (nickname, email, password_hash, bio, avatar_hash, verification_token)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (nickname, email, password_hash, bio, avatar_hash, token)).lastrowid
+                queue_verification_email(conn, email, token)
+                conn.commit()
+        except sqlite3.IntegrityError:
+            return jsonify({'status': 'error', 'message': 'Email already registered'}), 400
+        PROFILE_CACHE.bump(user_id)
+
+        EMAIL_OUTBOX.wake()
+        print(f"[SAVE_PROFILE] Created user {email}, queued token {token}")
         return jsonify({'status': 'ok', 'message': 'Verification email sent.'})
 
     except Exception as e:
@@ -1301,30 +4138,28 @@ def login_user():
         email = data.get('email', '').strip().lower()
         password = data.get('password', '').strip()
 
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, nickname, password_hash, is_verified, bio, profile_image FROM users WHERE email = ?", (email,))
-        row = cursor.fetchone()
-        conn.close()
+        with get_users_db() as conn:
+            row = conn.execute("SELECT id, nickname, password_hash, is_verified, bio, avatar_hash, profile_image FROM users WHERE email = ?", (email,)).fetchone()
 
         if not row:
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
 
-        user_id, nickname, password_hash, is_verified, bio, image = row
-        if not check_password_hash(password_hash, password):
-            return jsonify({'status': 'error', 'message': 'Incorrect password'}), 403
-
+        user_id, nickname, password_hash, is_verified, bio, avatar_hash, legacy_image = row
+        try:
+            if not PASSWORD_HASHER.verify(password_hash, password):
+                return jsonify({'status': 'error', 'message': 'Incorrect password'}), 403
+            if PASSWORD_HASHER.needs_rehash(password_hash):
+                rehash_password(user_id, password_hash, password)
+        except PasswordHasherBusy:
+            return password_hasher_busy()
+
+        profile = profile_from_row(nickname, email, bio, avatar_hash, legacy_image, is_verified)
         session['user_id'] = user_id
+        session['profile'] = {k: profile[k] for k in SESSION_PROFILE_FIELDS}
         return jsonify({
             'status': 'ok',
             'message': 'Login successful.',
-            'profile': {
-                'nickname': nickname,
-                'email': email,
-                'bio': bio,
-                'image': image,
-                'isVerified': bool(is_verified)
-            }
+            'profile': profile
         })
 
     except Exception as e:
@@ -1332,27 +4167,25 @@ def login_user():
 
 @app.route('/api/session_status')
 def session_status():
+    """
+    Full profile by default. `?fields=loggedIn` or `?fields=nickname,email`
+    (any of SESSION_PROFILE_FIELDS) is answered from the session cookie;
+    other fields go through PROFILE_CACHE and are trimmed to what was asked.
+    """
     user_id = session.get('user_id')
     if not user_id:
         return jsonify({'loggedIn': False})
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT nickname, email, bio, profile_image, is_verified FROM users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if not row:
+    fields = [f for f in request.args.get('fields', '').split(',') if f and f != 'loggedIn']
+    if 'fields' in request.args:
+        cached = session.get('profile') or {}
+        if all(f in cached for f in fields):
+            return jsonify({'loggedIn': True, 'profile': {f: cached[f] for f in fields}})
+    profile = load_profile(user_id)
+    if profile is None:
         return jsonify({'loggedIn': False})
-    nickname, email, bio, image, is_verified = row
-    return jsonify({
-        'loggedIn': True,
-        'profile': {
-            'nickname': nickname,
-            'email': email,
-            'bio': bio,
-            'image': image,
-            'isVerified': bool(is_verified)
-        }
-    })
+    if 'fields' in request.args:
+        profile = {f: profile[f] for f in fields if f in profile}
+    return jsonify({'loggedIn': True, 'profile': profile})
 
 @app.route('/api/logout', methods=['POST'])
 def logout_user():
@@ -1364,13 +4197,14 @@ def verify_email():
     token = request.args.get('token')
     if not token:
         return "Invalid verification link", 400
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET is_verified = 1 WHERE verification_token = ?", (token,))
-    updated = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return "Email verified successfully!" if updated else "Invalid or expired token.", 400
+    with get_users_db() as conn:
+        updated = conn.execute("UPDATE users SET is_verified = 1 WHERE verification_token = ? RETURNING id", (token,)).fetchall()
+        conn.commit()
+    if not updated:
+        return "Invalid or expired token.", 400
+    for (user_id,) in updated:
+        PROFILE_CACHE.bump(user_id)
+    return "Email verified successfully!"
 
 
 @app.route('/ar')
@@ -1379,25 +4213,6 @@ def ar_page():
 
     
 
-def send_verification_email(to_email, token):
-    try:
-        link = f"http://localhost:1111/verify_email?token={token}"
-        msg = MIMEText(f"Click to verify your email:\n\n{link}")
-        msg['Subject'] = 'Verify your Helena Paint account'
-        msg['From'] = 'noreply@yourdomain.com'
-        msg['To'] = to_email
-        print(f"[EMAIL] Sending to {to_email}, token: {token}")
-        smtp = smtplib.SMTP('smtp.yourdomain.com', 587)
-        smtp.starttls()
-        smtp.login('your_username', 'your_password')
-        smtp.send_message(msg)
-        smtp.quit()
-        print(f"[EMAIL] Sent to {to_email}")
-    except Exception as e:
-        print(f"[EMAIL ERROR] {type(e).__name__}: {e}")
-
-
-
 def generate_temp_ssl_cert():
     ssl_dir = "/tmp/ssl"
     os.makedirs(ssl_dir, exist_ok=True)
@@ -0,0 +1,17 @@
+# benchmarks/_env.py
+#
+# Import before `import app`: points the app at scratch databases in a fresh
+# temp dir (TMP) and puts webapp/ on sys.path. Set any benchmark-specific env
+# vars before importing this.
+#
+import os
+import sys
+import tempfile
+
+TMP = tempfile.mkdtemp(prefix="helena-bench-")
+os.environ.setdefault("SUBMIT_HMAC_SECRET", "bench-secret")
+os.environ["GAMES_DB_PATH"] = os.path.join(TMP, "games.db")
+os.environ["USERS_DB_PATH"] = os.path.join(TMP, "users.db")
+os.environ["HISTORY_DB_PATH"] = os.path.join(TMP, "History")
+os.environ["GALLERY_MANIFEST_PATH"] = os.path.join(TMP, "gallery_manifest.json")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,85 @@
+# benchmarks/bench_password_hash.py
+#
+# /api/leaderboard latency while a burst of /api/login requests is hashing:
+# hashes run inline in the request threads (the old behaviour) vs. on the
+# PasswordHasher process pool. Also counts logins turned away with 503.
+#
+#   python benchmarks/bench_password_hash.py [--logins 32] [--threads 8]
+#
+import argparse
+import os
+import statistics
+import threading
+import time
+
+os.environ["EMAIL_OUTBOX_SENDER"] = "0"
+import _env  # noqa: E402,F401  (scratch databases; before importing app)
+import app  # noqa: E402
+
+
+def _seed():
+    with app.get_users_db() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO users (nickname, email, password_hash, is_verified) VALUES (?, ?, ?, 1)",
+            ("Bench", "bench@example.com", app.generate_password_hash("pw", app.PASSWORD_HASHER.method)),
+        )
+        conn.commit()
+
+
+def run(label, hasher, logins, threads):
+    app.PASSWORD_HASHER = hasher
+    app.limiter.enabled = False
+    pending = list(range(logins))
+    lock = threading.Lock()
+    statuses = []
+
+    def login_worker():
+        client = app.app.test_client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                pending.pop()
+            resp = client.post("/api/login", json={"email": "bench@example.com", "password": "pw"})
+            with lock:
+                statuses.append(resp.status_code)
+
+    workers = [threading.Thread(target=login_worker) for _ in range(threads)]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    client = app.app.test_client()
+    latencies = []
+    while any(w.is_alive() for w in workers):
+        t = time.perf_counter()
+        client.get("/api/leaderboard?limit=10")
+        latencies.append((time.perf_counter() - t) * 1000.0)
+    for w in workers:
+        w.join()
+    dt = time.perf_counter() - t0
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+    print(f"{label:<22} burst {dt:6.2f}s  ok {statuses.count(200):>3}  503 {statuses.count(503):>3}  "
+          f"leaderboard p50 {statistics.median(latencies) if latencies else 0:7.2f}ms  p99 {p99:7.2f}ms")
+    hasher.shutdown()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark login hashing vs. other routes")
+    ap.add_argument("--logins", type=int, default=32)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--workers", type=int, default=2)
+    args = ap.parse_args()
+    _seed()
+
+    run("inline (workers=0)", app.PasswordHasher(workers=0), args.logins, args.threads)
+    pool = app.PasswordHasher(workers=args.workers, max_pending=args.threads)
+    pool.verify(app.SECRET_PIN_HASH, "warm-up")  # start the worker processes outside the timing
+    run(f"pool (workers={args.workers})", pool, args.logins, args.threads)
+    small = app.PasswordHasher(workers=args.workers, max_pending=args.workers)
+    small.verify(app.SECRET_PIN_HASH, "warm-up")
+    run(f"pool, queue={args.workers}", small, args.logins, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# benchmarks/bench_submit.py
+#
+# Score submissions/sec: the old three-connection, three-commit write path
+# vs. the single BEGIN IMMEDIATE transaction used by submit_result_public.
+#
+#   python benchmarks/bench_submit.py                 # scratch games.db
+#   python benchmarks/bench_submit.py --db games.db   # a copy of a local games.db
+#
+import argparse
+import os
+import shutil
+import sqlite3
+import time
+
+os.environ.setdefault("NONCE_BACKEND", "sqlite")  # keep the nonce claim in the measured transaction
+from _env import TMP  # noqa: E402  (scratch databases; before importing app)
+import app  # noqa: E402
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    return conn
+
+
+def _game(i, email):
+    return {
+        "user_key":      app.sha256_hex(email),
+        "nickname":      "Bench",
+        "email":         email,
+        "hits_made":     i % 51,
+        "target":        50,
+        "avg_precision": i % 101,
+        "outcome":       "miss",
+        "duration_ms":   1000,
+        "created_at":    app.now_ms(),
+    }
+
+
+def legacy_submit(path, nonce, cid, email, game):
+    """The pre-pipeline write path: nonce, users and games each on their own connection + commit."""
+    conn = _connect(path)
+    try:
+        if conn.execute("SELECT 1 FROM used_nonces WHERE nonce = ?", (nonce,)).fetchone():
+            return
+        conn.execute("INSERT INTO used_nonces (nonce, seen_at) VALUES (?, ?)", (nonce, app.now_ms()))
+        conn.execute("DELETE FROM used_nonces WHERE seen_at < ?", (app.now_ms() - 24 * 60 * 60 * 1000,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    conn = _connect(path)
+    try:
+        row = conn.execute("SELECT client_id FROM users WHERE email = ?", (email,)).fetchone()
+        if row is None or (row["client_id"] or "") not in ("", cid):
+            return
+        conn.execute("UPDATE users SET nickname = ?, last_seen = ? WHERE email = ?", (game["nickname"], app.now_ms(), email))
+        conn.commit()
+    finally:
+        conn.close()
+
+    conn = _connect(path)
+    try:
+        app.record_game(conn, game)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def pipeline_submit(pool, nonce, cid, email, game):
+    with pool.transaction() as conn:
+        app.write_submission(conn, nonce, cid, email, game["nickname"], game)
+
+
+def _prepare(src, dst, n_users):
+    if src:
+        shutil.copyfile(src, dst)
+    app.init_games_db(dst)
+    conn = sqlite3.connect(dst)
+    now = app.now_ms()
+    for u in range(n_users):
+        email = f"bench{u}@example.com"
+        conn.execute(
+            "INSERT OR IGNORE INTO users (email, user_key, client_id, created_at, last_seen) VALUES (?, ?, ?, ?, ?)",
+            (email, app.sha256_hex(email), f"cid{u}", now, now),
+        )
+    conn.commit()
+    conn.close()
+
+
+def run(label, submit, n, n_users):
+    t0 = time.perf_counter()
+    for i in range(n):
+        u = i % n_users
+        email = f"bench{u}@example.com"
+        submit(os.urandom(8).hex(), f"cid{u}", email, _game(i, email))
+    dt = time.perf_counter() - t0
+    print(f"{label:<34} {n:>6} submissions  {dt:7.3f}s  {n / dt:9.1f} submissions/sec")
+    return n / dt
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark score submission write paths")
+    ap.add_argument("--db", help="games.db to copy as the starting dataset (default: empty)")
+    ap.add_argument("-n", type=int, default=2000, help="submissions per run")
+    ap.add_argument("--users", type=int, default=200)
+    args = ap.parse_args()
+
+    legacy_db = os.path.join(TMP, "legacy.db")
+    pipeline_db = os.path.join(TMP, "pipeline.db")
+    _prepare(args.db, legacy_db, args.users)
+    _prepare(args.db, pipeline_db, args.users)
+
+    before = run("before: 3 connections / 3 commits", lambda *a: legacy_submit(legacy_db, *a), args.n, args.users)
+    pool = app.SQLitePool(pipeline_db, pragmas=("PRAGMA journal_mode=WAL;", "PRAGMA busy_timeout=5000;"))
+    after = run("after: 1 pooled BEGIN IMMEDIATE", lambda *a: pipeline_submit(pool, *a), args.n, args.users)
+    print(f"speedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
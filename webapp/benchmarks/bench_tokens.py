@@ -0,0 +1,93 @@
+# benchmarks/bench_tokens.py
+#
+# Submit-token verifications/sec for the HMAC variants considered for
+# verify_token(): re-encoding the secret on every call (the original), the
+# module-level SUBMIT_HMAC_KEY (current), copying a pre-keyed hmac object, and
+# the one-shot hmac.digest(). Each variant runs several rounds over the same
+# fresh tokens and reports its best round, since single runs are noisy.
+#
+#   python benchmarks/bench_tokens.py [-n 100000] [--rounds 5]
+#
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import time
+
+import _env  # noqa: E402,F401  (scratch databases; before importing app)
+import app  # noqa: E402
+
+
+def _verifier(digest):
+    """verify_token() with the signature computed by `digest(msg)`."""
+    def verify(tok):
+        try:
+            msg_b64, sig_b64 = tok.split(".", 1)
+            msg = app._b64u_decode(msg_b64)
+            sig = app._b64u_decode(sig_b64)
+            if not hmac.compare_digest(sig, digest(msg)):
+                return None
+            payload = json.loads(msg.decode("utf-8"))
+            if int(payload.get("exp", 0)) < int(time.time()) - 30:
+                return None
+            return payload
+        except Exception:
+            return None
+    return verify
+
+
+def _keyed_copy():
+    keyed = hmac.new(app.SUBMIT_HMAC_KEY, digestmod=hashlib.sha256)
+
+    def digest(msg):
+        h = keyed.copy()
+        h.update(msg)
+        return h.digest()
+    return digest
+
+
+VARIANTS = [
+    ("encode per call", _verifier(
+        lambda msg: hmac.new(app.SUBMIT_HMAC_SECRET.encode("utf-8"), msg, hashlib.sha256).digest())),
+    ("SUBMIT_HMAC_KEY (current)", app.verify_token),
+    ("pre-keyed .copy()", _verifier(_keyed_copy())),
+    ("hmac.digest one-shot", _verifier(lambda msg: hmac.digest(app.SUBMIT_HMAC_KEY, msg, "sha256"))),
+]
+
+
+def _token(i):
+    return app.sign_token({
+        "cid": f"bench-{i}",
+        "emh": app.sha256_hex(f"bench{i}@example.com"),
+        "ua": "Mozilla/5.0 (bench)",
+        "ip": "",
+        "exp": int(time.time()) + 3600,
+        "n": os.urandom(8).hex(),
+    })
+
+
+def run(label, verify, tokens, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for tok in tokens:
+            if verify(tok) is None:
+                raise AssertionError(f"{label}: rejected a valid token")
+        best = min(best, time.perf_counter() - t0)
+    print(f"{label:<28} {len(tokens):>8} verifications  best {best:7.3f}s  {len(tokens) / best:12.0f} tokens/sec")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark submit-token verification")
+    ap.add_argument("-n", type=int, default=100_000)
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args()
+
+    tokens = [_token(i) for i in range(args.n)]
+    for label, verify in VARIANTS:
+        run(label, verify, tokens, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
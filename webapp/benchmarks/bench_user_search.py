@@ -0,0 +1,91 @@
+# benchmarks/bench_user_search.py
+#
+# /api/users/search latency on a synthetic directory: the prebuilt prefix +
+# trigram index vs. a linear substring scan over every user, per query.
+#
+#   python benchmarks/bench_user_search.py [--users 100000] [--queries 2000]
+#
+import argparse
+import random
+import string
+import time
+
+import _env  # noqa: E402,F401  (scratch databases; before importing app)
+import app  # noqa: E402
+
+FIRST = ["alice", "bob", "carol", "dmitri", "elena", "farid", "grace", "helena", "ivan", "julia",
+         "kenji", "lena", "marta", "nikolai", "olga", "pavel", "quinn", "rosa", "sven", "tanya"]
+LAST = ["smith", "ivanova", "garcia", "muller", "rossi", "novak", "kowalski", "tanaka", "silva",
+        "petrov", "jensen", "dubois", "horvat", "nielsen", "kuznetsov", "moreau", "fischer", "lopez"]
+COMPANY = ["acme", "globex", "initech", "umbrella", "hooli", "vandelay", "stark", "wayne", "tyrell",
+           "cyberdyne", "soylent", "aperture", "wonka", "gringotts", "monsters"]
+
+
+def _users(rng, n):
+    users = []
+    for i in range(n):
+        first, last = rng.choice(FIRST), rng.choice(LAST)
+        suffix = "".join(rng.choices(string.ascii_lowercase, k=3))
+        users.append({
+            "name": f"{first.title()} {last.title()}{suffix}",
+            "email": f"{first}.{last}{i}@{rng.choice(COMPANY)}.com",
+            "company": f"{rng.choice(COMPANY).title()} {rng.choice(['Labs', 'Inc', 'GmbH', 'Group'])} {i % 500}",
+        })
+    return users
+
+
+def _typo(rng, word):
+    i = rng.randrange(len(word))
+    return word[:i] + rng.choice(string.ascii_lowercase) + word[i + 1:]
+
+
+def _queries(rng, n):
+    qs = []
+    for _ in range(n):
+        kind = rng.random()
+        if kind < 0.4:
+            qs.append(rng.choice(FIRST)[:rng.randint(1, 4)])          # typing a name
+        elif kind < 0.7:
+            qs.append(rng.choice(COMPANY)[:rng.randint(2, 6)])        # typing a company
+        else:
+            qs.append(_typo(rng, rng.choice(FIRST + LAST)))          # misspelled
+    return qs
+
+
+def linear_search(users, q, limit=20):
+    q = q.strip().lower()
+    hits = [u for u in users
+            if q in (u["name"] or "").lower() or q in (u["email"] or "").lower() or q in (u["company"] or "").lower()]
+    return hits[:limit]
+
+
+def run(label, search, queries):
+    times = []
+    for q in queries:
+        t0 = time.perf_counter()
+        search(q)
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    pct = lambda p: times[min(len(times) - 1, int(p * len(times)))] * 1000
+    print(f"{label:<22} {len(times):>6} queries  p50 {pct(0.50):8.3f}ms  p95 {pct(0.95):8.3f}ms  p99 {pct(0.99):8.3f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark user directory search")
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--queries", type=int, default=2000)
+    args = ap.parse_args()
+
+    rng = random.Random(7)
+    directory = app.UserDirectorySnapshot(_users(rng, args.users))
+    t0 = time.perf_counter()
+    index = directory.search_index
+    print(f"index build: {len(directory.users)} users in {time.perf_counter() - t0:.2f}s")
+
+    queries = _queries(rng, args.queries)
+    run("linear substring scan", lambda q: linear_search(directory.users, q), queries[: max(1, args.queries // 10)])
+    run("prefix + trigram index", lambda q: index.search(q), queries)
+
+
+if __name__ == "__main__":
+    main()
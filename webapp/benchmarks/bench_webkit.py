@@ -0,0 +1,73 @@
+# benchmarks/bench_webkit.py
+#
+# Webkit timestamp -> string conversions/sec: the per-row datetime + timedelta
+# path vs. webkit_to_iso_batch() on a whole column, for both the export format
+# (isoformat) and the /history display format (seconds, space separated).
+#
+#   python benchmarks/bench_webkit.py [-n 500000] [--batch 1000]
+#
+import argparse
+import random
+import time
+
+import _env  # noqa: E402,F401  (scratch databases; before importing app)
+import app  # noqa: E402
+
+
+def per_row_iso(column):
+    return [app.webkit_to_datetime(t).isoformat() if t else None for t in column]
+
+
+def per_row_display(column):
+    return [app.webkit_to_datetime(t).strftime('%Y-%m-%d %H:%M:%S') if t else "Unknown" for t in column]
+
+
+def batch_iso(column):
+    return app.webkit_to_iso_batch(column)
+
+
+def batch_display(column):
+    return app.webkit_to_iso_batch(column, sep=' ', seconds_only=True, missing="Unknown")
+
+
+def _column(rng, n):
+    # Chrome-era timestamps; a few nulls and whole-second values for the edge cases
+    base = 13_300_000_000_000_000
+    col = [base + rng.randrange(10 ** 14) for _ in range(n)]
+    for i in range(1, n, 89):
+        col[i] -= col[i] % 1_000_000
+    for i in range(0, n, 97):
+        col[i] = None
+    return col
+
+
+def run(label, convert, chunks):
+    t0 = time.perf_counter()
+    out = [s for chunk in chunks for s in convert(chunk)]
+    dt = time.perf_counter() - t0
+    print(f"{label:<28} {len(out):>8} rows  {dt:7.3f}s  {len(out) / dt:12.0f} rows/sec")
+    return out, len(out) / dt
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark webkit timestamp formatting")
+    ap.add_argument("-n", type=int, default=500_000)
+    ap.add_argument("--batch", type=int, default=1000, help="rows per chunk (export fetches 1000 at a time)")
+    args = ap.parse_args()
+
+    col = _column(random.Random(42), args.n)
+    chunks = [col[i:i + args.batch] for i in range(0, len(col), args.batch)]
+
+    expected, before = run("per-row isoformat", per_row_iso, chunks)
+    got, after = run("batch isoformat", batch_iso, chunks)
+    assert got == expected
+    print(f"speedup: {after / before:.2f}x")
+
+    expected, before = run("per-row strftime", per_row_display, chunks)
+    got, after = run("batch display", batch_display, chunks)
+    assert got == expected
+    print(f"speedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
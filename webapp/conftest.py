@@ -0,0 +1,13 @@
+# conftest.py — points app.py at scratch databases before any test imports it
+import os
+import sys
+import tempfile
+
+TMP = tempfile.mkdtemp(prefix="helena-test-")
+os.environ.setdefault("SUBMIT_HMAC_SECRET", "test-secret")
+os.environ["GAMES_DB_PATH"] = os.path.join(TMP, "games.db")
+os.environ["USERS_DB_PATH"] = os.path.join(TMP, "users.db")
+os.environ["HISTORY_DB_PATH"] = os.path.join(TMP, "History")
+os.environ["GALLERY_MANIFEST_PATH"] = os.path.join(TMP, "gallery_manifest.json")
+os.environ["EMAIL_OUTBOX_SENDER"] = "0"  # tests drive send_due() themselves
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
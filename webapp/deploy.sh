@@ -33,6 +33,7 @@ rsync -avz -e "ssh -p $REMOTE_PORT" --delete \
     --exclude '.DS_Store' \
     --exclude 'private_trash/' \
     --exclude 'static/images/gallery1/' \
+    --exclude 'static/avatars/' \
     "$LOCAL_DIR" "$REMOTE_USER@$REMOTE_HOST:$REMOTE_DIR"
 
 echo "=== Writing .env file on remote ==="
@@ -56,6 +57,16 @@ else
 fi
 EOF
 
+echo "=== Precompressing static assets ==="
+ssh -p $REMOTE_PORT $REMOTE_USER@$REMOTE_HOST << EOF
+cd $REMOTE_DIR
+if [ -x venv/bin/flask ]; then
+    FLASK_APP=app.py venv/bin/flask build-assets
+else
+    echo "⚠️ venv/bin/flask not found. Skipping precompression."
+fi
+EOF
+
 echo "=== Restarting Flask service on remote ==="
 ssh -p $REMOTE_PORT $REMOTE_USER@$REMOTE_HOST "systemctl restart helena_flask && systemctl status helena_flask --no-pager"
 
@@ -69,6 +80,10 @@ chown -R www-data:www-data static/fonts
 chown -R www-data:www-data static/images/gallery1
 chmod -R 775 static/images/gallery1
 
+mkdir -p static/avatars
+chown -R www-data:www-data static/avatars
+chmod -R 775 static/avatars
+
 if [ -f History ]; then
     chmod 644 History
     echo "=== Set permissions for History file ==="
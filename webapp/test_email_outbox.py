@@ -0,0 +1,143 @@
+# test_email_outbox.py — run with: python -m pytest -q test_email_outbox.py
+import os
+import socketserver
+import tempfile
+import threading
+
+import app
+
+
+class StubSMTP(socketserver.ThreadingTCPServer):
+    """Just enough SMTP for smtplib: records connections and delivered messages."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.connections = 0
+        self.messages = []   # (rcpt, data)
+        self.rcpt_replies = {}  # address -> reply line, e.g. "550 no such user"
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 stub ready")
+        rcpt = None
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            cmd = line.split(" ", 1)[0].upper()
+            if cmd in ("EHLO", "HELO"):
+                self.reply("250 stub")
+            elif cmd == "MAIL":
+                self.reply("250 ok")
+            elif cmd == "RCPT":
+                rcpt = line.split(":", 1)[1].strip().strip("<>")
+                self.reply(self.server.rcpt_replies.get(rcpt, "250 ok"))
+            elif cmd == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while True:
+                    chunk = self.rfile.readline().decode()
+                    if chunk in (".\r\n", ""):
+                        break
+                    data.append(chunk)
+                self.server.messages.append((rcpt, "".join(data)))
+                self.reply("250 queued")
+            elif cmd == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+def _outbox(port, **kwargs):
+    path = os.path.join(tempfile.mkdtemp(prefix="helena-test-"), "users.db")
+    app.init_user_db(path)
+    pool = app.SQLitePool(path, pragmas=("PRAGMA journal_mode=WAL;", "PRAGMA busy_timeout=5000;"))
+    smtp = app.SMTPConfig(host="127.0.0.1", port=port, starttls=False, timeout=5.0)
+    return app.EmailOutbox(pool, smtp, **kwargs)
+
+
+def _queue(outbox, *addrs):
+    with outbox.pool.connection() as conn:
+        for addr in addrs:
+            outbox.enqueue(conn, addr, "Hello", f"Hi {addr}")
+        conn.commit()
+
+
+def _rows(outbox):
+    with outbox.pool.connection() as conn:
+        return {r["to_addr"]: r for r in conn.execute("SELECT * FROM email_outbox")}
+
+
+def test_batch_goes_out_over_one_connection():
+    server = StubSMTP()
+    outbox = _outbox(server.port)
+    _queue(outbox, "a@example.com", "b@example.com", "c@example.com")
+
+    outbox.send_due()
+
+    assert server.connections == 1
+    assert sorted(r for r, _ in server.messages) == ["a@example.com", "b@example.com", "c@example.com"]
+    assert "Hi b@example.com" in dict(server.messages)["b@example.com"]
+    assert all(r["status"] == "sent" and r["attempts"] == 1 for r in _rows(outbox).values())
+
+
+def test_transient_failure_is_retried_and_permanent_one_is_not():
+    server = StubSMTP()
+    server.rcpt_replies = {"busy@example.com": "451 try later", "gone@example.com": "550 no such user"}
+    outbox = _outbox(server.port)
+    _queue(outbox, "busy@example.com", "gone@example.com", "ok@example.com")
+
+    before = app.now_ms()
+    outbox.send_due()
+    rows = _rows(outbox)
+    assert rows["ok@example.com"]["status"] == "sent"
+    assert rows["gone@example.com"]["status"] == "failed"
+    busy = rows["busy@example.com"]
+    assert busy["status"] == "pending" and busy["attempts"] == 1
+    assert busy["next_attempt_at"] >= before + outbox.base_delay * 500  # backed off
+    assert "451" in busy["last_error"]
+
+    # Not due yet: a second pass sends nothing
+    outbox.send_due()
+    assert len(server.messages) == 1
+
+    server.rcpt_replies = {}
+    with outbox.pool.connection() as conn:
+        conn.execute("UPDATE email_outbox SET next_attempt_at = 0 WHERE to_addr = 'busy@example.com'")
+        conn.commit()
+    outbox.send_due()
+    rows = _rows(outbox)
+    assert rows["busy@example.com"]["status"] == "sent" and rows["busy@example.com"]["attempts"] == 2
+
+
+def test_unreachable_server_keeps_mail_pending():
+    server = StubSMTP()
+    port = server.port
+    server.shutdown()
+    server.server_close()
+    outbox = _outbox(port, max_attempts=2)
+    _queue(outbox, "a@example.com")
+
+    outbox.send_due()
+    row = _rows(outbox)["a@example.com"]
+    assert row["status"] == "pending" and row["attempts"] == 1 and row["next_attempt_at"] > app.now_ms()
+
+    with outbox.pool.connection() as conn:
+        conn.execute("UPDATE email_outbox SET next_attempt_at = 0")
+        conn.commit()
+    outbox.send_due()
+    assert _rows(outbox)["a@example.com"]["status"] == "failed"  # out of attempts
@@ -0,0 +1,204 @@
+# test_history.py — run with: python -m pytest -q test_history.py
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+
+import pytest
+
+import app
+
+WORDS = ["kitten", "kit", "ten", "exec", "e_c", "python", "dog", "tenant", "50%", "spec", "recipe"]
+HOSTS = ["example.com", "docs.python.org", "news.example.org", "exec-spec.net"]
+T0 = app.datetime_to_webkit("2024-03-01")
+
+
+def _write_history(path, n_urls=120, seed=7):
+    """A small Chrome-shaped History: urls, visits (with ties and zero times) and search terms."""
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE urls (id INTEGER PRIMARY KEY, url LONGVARCHAR, title LONGVARCHAR);
+        CREATE TABLE visits (id INTEGER PRIMARY KEY, url INTEGER NOT NULL, visit_time INTEGER NOT NULL,
+                             transition INTEGER DEFAULT 0 NOT NULL);
+        CREATE TABLE keyword_search_terms (keyword_id INTEGER NOT NULL, url_id INTEGER NOT NULL,
+                                           term LONGVARCHAR NOT NULL, normalized_term LONGVARCHAR NOT NULL);
+    """)
+    for url_id in range(1, n_urls + 1):
+        title = " ".join(rng.sample(WORDS, 2)) if rng.random() < 0.8 else None
+        conn.execute("INSERT INTO urls VALUES (?, ?, ?)",
+                     (url_id, f"https://{rng.choice(HOSTS)}/{rng.choice(WORDS)}/{url_id}", title))
+        for term in rng.sample(WORDS, rng.randint(0, 3)):
+            conn.execute("INSERT INTO keyword_search_terms VALUES (1, ?, ?, ?)", (url_id, term, term))
+        for _ in range(rng.randint(1, 3)):
+            # Few distinct times, so plenty of rows tie on the date sort key
+            visit_time = T0 + rng.randint(0, 20) * 3_600_000_000 if rng.random() < 0.95 else 0
+            conn.execute("INSERT INTO visits (url, visit_time, transition) VALUES (?, ?, ?)",
+                         (url_id, visit_time, rng.choice([0, 1, 2, 0x30000001])))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(scope="module")
+def client():
+    tmp = os.path.join(tempfile.mkdtemp(prefix="helena-test-"), "History")
+    _write_history(tmp)
+    os.replace(tmp, app.HISTORY_DB)  # new inode: the snapshot pool reopens
+    return app.app.test_client()
+
+
+def _status(resp):
+    return re.search(r"Showing page \d+ of \d+, \d+ total record\(s\)\.|Error reading history: [^<]*",
+                     resp.get_data(as_text=True)).group(0)
+
+
+def test_webkit_batch_matches_per_row():
+    column = [T0, T0 + 1, T0 + 1_500_000, 0, None, 13_350_000_000_123_456]
+    expected = [app.webkit_to_datetime(t).isoformat() if t else None for t in column]
+    assert app.webkit_to_iso_batch(column) == expected
+
+    display = [app.webkit_to_datetime(t).strftime('%Y-%m-%d %H:%M:%S') if t else "Unknown" for t in column]
+    assert app.webkit_to_iso_batch(column, sep=' ', seconds_only=True, missing="Unknown") == display
+
+
+def test_webkit_batch_empty_and_missing():
+    assert app.webkit_to_iso_batch([]) == []
+    assert app.webkit_to_iso_batch(iter(()), sep=' ', seconds_only=True, missing="Unknown") == []
+    assert app.webkit_to_iso_batch([0, None], sep=' ', missing="Unknown") == ["Unknown", "Unknown"]
+
+
+def test_search_without_matches_reports_zero(client):
+    for q in ("zzzznotfound", "a_p_q_r", "e_c_x"):
+        assert _status(client.get("/history", query_string={"query": q})) == \
+            "Showing page 1 of 1, 0 total record(s)."
+
+
+@pytest.fixture
+def rendered(client, monkeypatch):
+    """GET /history and return the context it rendered history.html with."""
+    seen = {}
+    real = app.render_template
+
+    def spy(name, **context):
+        seen.update(context)
+        return real(name, **context)
+
+    monkeypatch.setattr(app, "render_template", spy)
+
+    def get(**params):
+        seen.clear()
+        client.get("/history", query_string=params)
+        return dict(seen)
+    return get
+
+
+@pytest.fixture
+def fts_index(client, monkeypatch):
+    index = app.HistoryIndex(app.HISTORY_DB, os.path.join(tempfile.mkdtemp(prefix="helena-test-"), "index.db"))
+    index.ensure_fresh()  # first build runs in the background
+    deadline = time.monotonic() + 10
+    while not index.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index.ready
+    monkeypatch.setattr(app, "HISTORY_INDEX", index)
+    app.HISTORY_POOL.close()  # reconnect so the sidecar gets attached
+    yield index
+    app.HISTORY_POOL.close()
+
+
+def _walk(rendered, **params):
+    """Every row of a listing, following the Next cursors; plus the reported total pages."""
+    page = rendered(**params)
+    rows, total_pages = list(page["results"]), page["total_pages"]
+    while page["next_cursor"]:
+        page = rendered(after=page["next_cursor"], **params)
+        rows += page["results"]
+    return rows, total_pages
+
+
+@pytest.mark.parametrize("q", ["kitten", "ten", "exec", "spec", "docs.python", "e_c", "t_n", "%ec", "50%", "_"])
+def test_fts_prefilter_matches_like(rendered, fts_index, q, monkeypatch):
+    literal = "%" not in q and "_" not in q and len(q) >= 3
+    assert app.history_index_ready(q) == literal  # wildcard queries bypass the index
+    indexed = _walk(rendered, query=q)
+    monkeypatch.setattr(app, "HISTORY_INDEX", None)
+    app.HISTORY_POOL.close()
+    unindexed = _walk(rendered, query=q)
+    assert indexed == unindexed
+    assert unindexed[0]  # the query does find rows
+
+
+def _offset_pages(sort, where="", values=()):
+    """The same listing paged with LIMIT/OFFSET straight from the History file."""
+    sort_key = app.HISTORY_SORT_KEYS[sort]
+    conn = sqlite3.connect(app.HISTORY_DB)
+    pages = []
+    while True:
+        rows = conn.execute(f"""
+            SELECT u.id, u.title, u.url, v.visit_time, v.transition, k.term
+            FROM urls u
+            JOIN visits v ON u.id = v.url
+            LEFT JOIN keyword_search_terms k ON k.url_id = u.id
+            {where}
+            ORDER BY {sort_key} DESC, v.id DESC, COALESCE(k.rowid, 0) DESC
+            LIMIT 50 OFFSET ?
+        """, (*values, 50 * len(pages))).fetchall()
+        if not rows:
+            break
+        dates = app.webkit_to_iso_batch((r[3] for r in rows), sep=' ', seconds_only=True, missing="Unknown")
+        pages.append([
+            {'id': r[0], 'title': r[1], 'url': r[2], 'date': d, 'transition': r[4], 'term': r[5]}
+            for r, d in zip(rows, dates)
+        ])
+    conn.close()
+    return pages or [[]]
+
+
+FILTERS = [
+    ({}, "", ()),
+    ({"query": "ten"}, "WHERE (u.title LIKE ? OR u.url LIKE ? OR k.term LIKE ?)", ("%ten%",) * 3),
+    ({"visit_type": "typed"}, "WHERE (v.transition & 0xff) = 1", ()),
+    ({"date_from": "2024-03-01", "date_to": "2024-03-01"},
+     "WHERE v.visit_time >= ? AND v.visit_time <= ?", (T0, T0)),
+]
+
+
+@pytest.mark.parametrize("sort", sorted(app.HISTORY_SORT_KEYS))
+@pytest.mark.parametrize("params,where,values", FILTERS)
+def test_cursor_paging_matches_offset_paging(rendered, sort, params, where, values):
+    expected = _offset_pages(sort, where, values)
+
+    # Forward with the Next cursors
+    page = rendered(sort=sort, **params)
+    seen = [page]
+    while page["next_cursor"]:
+        page = rendered(sort=sort, after=page["next_cursor"], page=page["page"] + 1, **params)
+        seen.append(page)
+    assert [p["results"] for p in seen] == expected
+    assert [p["page"] for p in seen] == list(range(1, len(expected) + 1))
+    assert all(p["total_pages"] == len(expected) for p in seen)
+    assert seen[0]["prev_cursor"] is None
+
+    # And back again with the Previous cursors, ending on page 1
+    back = [page]
+    while page["prev_cursor"]:
+        page = rendered(sort=sort, before=page["prev_cursor"], page=page["page"] - 1, **params)
+        back.append(page)
+    assert [p["results"] for p in reversed(back)] == expected
+    assert [p["page"] for p in reversed(back)] == list(range(1, len(expected) + 1))
+    assert len(expected) == 1 or back[-1]["next_cursor"] is not None
+
+
+def test_fixture_has_ties_on_every_sort_key(client):
+    conn = sqlite3.connect(app.HISTORY_DB)
+    for sort_key in app.HISTORY_SORT_KEYS.values():
+        (ties,) = conn.execute(f"""
+            SELECT COUNT(*) FROM (
+                SELECT {sort_key} FROM urls u JOIN visits v ON u.id = v.url
+                LEFT JOIN keyword_search_terms k ON k.url_id = u.id
+                GROUP BY 1 HAVING COUNT(*) > 1)
+        """).fetchone()
+        assert ties > 0, sort_key
+    conn.close()
@@ -0,0 +1,144 @@
+# test_leaderboard.py — run with: python -m pytest -q test_leaderboard.py
+import os
+import random
+import sqlite3
+import tempfile
+
+import app
+
+
+# The ranking query /api/leaderboard/me used before the rank index existed
+LEGACY_RANK_SQL = """
+    WITH per_user_best AS (
+      SELECT
+        user_key, hits_made, avg_precision, created_at,
+        ROW_NUMBER() OVER (
+          PARTITION BY user_key
+          ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
+        ) AS rn
+      FROM games
+    ),
+    ranked AS (
+      SELECT
+        user_key,
+        ROW_NUMBER() OVER (
+          ORDER BY hits_made DESC, avg_precision DESC, created_at ASC
+        ) AS rnk
+      FROM per_user_best
+      WHERE rn = 1
+    )
+    SELECT user_key, rnk FROM ranked
+"""
+
+
+def _scratch_db():
+    path = os.path.join(tempfile.mkdtemp(prefix="helena-test-"), "games.db")
+    app.init_games_db(path)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _random_games(rng, conn, n_games, n_users, t0):
+    for i in range(n_games):
+        app.record_game(conn, {
+            "user_key":      f"u{rng.randrange(n_users)}",
+            "nickname":      "Player",
+            "email":         None,
+            "hits_made":     rng.randint(0, 5),   # narrow ranges force plenty of ties
+            "target":        50,
+            "avg_precision": rng.randint(0, 3),
+            "outcome":       "miss",
+            "duration_ms":   None,
+            "created_at":    t0 + i,             # distinct, so the legacy order is total
+        })
+    conn.commit()
+
+
+def _assert_ranks_match(conn, index):
+    expected = {r["user_key"]: r["rnk"] for r in conn.execute(LEGACY_RANK_SQL)}
+    for ukey, rnk in expected.items():
+        row = conn.execute("SELECT * FROM user_best WHERE user_key = ?", (ukey,)).fetchone()
+        assert index.rank_of(conn, row) == rnk, ukey
+    assert len(index) == len(expected)
+
+
+def test_rank_index_matches_legacy_sql():
+    rng = random.Random(1234)
+    conn = _scratch_db()
+    _random_games(rng, conn, n_games=2000, n_users=300, t0=1_000_000)
+
+    index = app.RankIndex()
+    index.rebuild(conn)
+    _assert_ranks_match(conn, index)
+
+
+def test_rank_index_follows_new_games():
+    rng = random.Random(99)
+    conn = _scratch_db()
+    _random_games(rng, conn, n_games=500, n_users=120, t0=1_000_000)
+
+    index = app.RankIndex()
+    index.rebuild(conn)
+    # New games (some improving existing users, some new users) must be
+    # picked up incrementally by the next lookup.
+    _random_games(rng, conn, n_games=500, n_users=200, t0=2_000_000)
+    _assert_ranks_match(conn, index)
+
+
+def test_user_best_matches_rebuild():
+    rng = random.Random(7)
+    conn = _scratch_db()
+    _random_games(rng, conn, n_games=800, n_users=150, t0=1_000_000)
+
+    cols = "user_key, game_id, hits_made, avg_precision, created_at"
+    incremental = conn.execute(f"SELECT {cols} FROM user_best ORDER BY user_key").fetchall()
+    app.rebuild_user_best(conn)
+    rebuilt = conn.execute(f"SELECT {cols} FROM user_best ORDER BY user_key").fetchall()
+    assert [tuple(r) for r in incremental] == [tuple(r) for r in rebuilt]
+
+
+def test_record_games_batch_matches_rebuild():
+    rng = random.Random(21)
+    conn = _scratch_db()
+    _random_games(rng, conn, n_games=100, n_users=50, t0=1_000_000)
+
+    batch = [{
+        "user_key":      f"u{rng.randrange(80)}",
+        "nickname":      "Player",
+        "email":         None,
+        "hits_made":     rng.randint(0, 5),
+        "target":        50,
+        "avg_precision": rng.randint(0, 3),
+        "outcome":       "miss",
+        "duration_ms":   None,
+        "created_at":    2_000_000 + i,
+    } for i in range(300)]
+    conn.execute("BEGIN IMMEDIATE")
+    app.record_games(conn, batch)
+    conn.commit()
+
+    cols = "user_key, game_id, hits_made, avg_precision, created_at"
+    batched = conn.execute(f"SELECT {cols} FROM user_best ORDER BY user_key").fetchall()
+    app.rebuild_user_best(conn)
+    rebuilt = conn.execute(f"SELECT {cols} FROM user_best ORDER BY user_key").fetchall()
+    assert [tuple(r) for r in batched] == [tuple(r) for r in rebuilt]
+
+
+def test_migrations_upgrade_unversioned_games_db():
+    # A games.db from before user_version: only the original games table
+    path = os.path.join(tempfile.mkdtemp(prefix="helena-test-"), "games.db")
+    conn = sqlite3.connect(path)
+    conn.execute(app.GAMES_MIGRATIONS[0][0])
+    conn.execute("INSERT INTO games (email, hits_made, target, avg_precision, outcome, created_at)"
+                 " VALUES (' A@x.com ', 1, 50, 1, 'miss', 1)")
+    conn.commit()
+
+    assert app.migrate(path, app.GAMES_MIGRATIONS) == len(app.GAMES_MIGRATIONS)
+    assert app.migrate(path, app.GAMES_MIGRATIONS) == 0
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(app.GAMES_MIGRATIONS)
+    assert conn.execute("SELECT COUNT(*) FROM games").fetchone()[0] == 1
+    plan = " ".join(r[3] for r in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT DISTINCT LOWER(TRIM(email)) FROM games"
+        " WHERE email IS NOT NULL AND TRIM(email) <> ''"))
+    assert "idx_games_email_norm" in plan
@@ -0,0 +1,127 @@
+# test_nonce_store.py — run with: python -m pytest -q test_nonce_store.py
+import os
+import tempfile
+
+import pytest
+
+import app
+
+WINDOW = 3600
+BUCKET = 600
+T0 = 1_000_000 * BUCKET  # on a bucket boundary
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(float(T0))
+    monkeypatch.setattr(app.time, "time", clock)
+    return clock
+
+
+def _pool():
+    path = os.path.join(tempfile.mkdtemp(prefix="helena-test-"), "games.db")
+    app.init_games_db(path)
+    return app.SQLitePool(path, pragmas=("PRAGMA journal_mode=WAL;", "PRAGMA busy_timeout=5000;"))
+
+
+def _sqlite_store(pool=None):
+    # Sweep on every claim so expiry is visible without waiting out sweep_seconds
+    return app.SQLiteNonceStore(WINDOW, pool or _pool(), sweep_seconds=0)
+
+
+def _claim(store, nonce):
+    """One claim the way submit_result_public makes it: in its own write transaction if the store needs one."""
+    if not store.needs_conn:
+        return store.claim(nonce)
+    with store.pool.transaction() as conn:
+        return store.claim(nonce, conn)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, clock):
+    if request.param == "memory":
+        return app.MemoryNonceStore(WINDOW, bucket_seconds=BUCKET)
+    return _sqlite_store()
+
+
+def test_nonce_store_is_abstract():
+    with pytest.raises(TypeError):
+        app.NonceStore()
+
+
+def test_repeat_is_rejected(store):
+    assert _claim(store, "n1") is True
+    assert _claim(store, "n1") is False
+    assert _claim(store, "n2") is True
+    assert _claim(store, "") is False
+
+
+def test_release_allows_the_retry(store):
+    assert _claim(store, "n1") is True
+    store.release("n1")  # after the claim committed: write-behind flush failed
+    assert _claim(store, "n1") is True
+    assert _claim(store, "n1") is False
+
+
+def test_claim_is_remembered_for_the_whole_window(store, clock):
+    assert _claim(store, "n1") is True
+    clock.now = T0 + WINDOW - 1
+    assert _claim(store, "n1") is False
+    clock.now = T0 + WINDOW + BUCKET + 1
+    assert _claim(store, "n1") is True
+
+
+def test_memory_ring_recycles_expired_buckets(clock):
+    store = app.MemoryNonceStore(WINDOW, bucket_seconds=BUCKET)
+    slots = len(store._buckets)
+    for i in range(3 * slots):
+        clock.now = T0 + i * BUCKET
+        assert store.claim(f"n{i}") is True
+    # Only the buckets still inside the ring hold nonces
+    assert store.stats()["nonces"] == slots
+    assert store.claim(f"n{3 * slots - 1}") is False
+    assert store.claim("n0") is True
+
+
+def test_sqlite_claim_needs_the_transaction(clock):
+    with pytest.raises(ValueError):
+        _sqlite_store().claim("n1")
+
+
+def test_sqlite_rollback_and_in_transaction_release(clock):
+    store = _sqlite_store()
+    with pytest.raises(RuntimeError):
+        with store.pool.transaction() as conn:
+            assert store.claim("n1", conn) is True
+            raise RuntimeError("insert failed")
+    assert _claim(store, "n1") is True  # the rollback took the claim with it
+
+    with store.pool.transaction() as conn:
+        assert store.claim("n2", conn) is True
+        store.release("n2", conn)
+    assert _claim(store, "n2") is True
+
+
+def test_sqlite_claims_are_shared_between_stores(clock):
+    pool = _pool()
+    worker_a, worker_b = _sqlite_store(pool), _sqlite_store(app.SQLitePool(pool.path))
+    assert _claim(worker_a, "n1") is True
+    assert _claim(worker_b, "n1") is False
+
+
+def test_sqlite_sweep_removes_expired_rows(clock):
+    store = _sqlite_store()
+    for i in range(5):
+        assert _claim(store, f"old{i}") is True
+    clock.now = T0 + WINDOW + 1
+    assert _claim(store, "new") is True
+    with store.pool.connection() as conn:
+        assert [r[0] for r in conn.execute("SELECT nonce FROM used_nonces")] == ["new"]
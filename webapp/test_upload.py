@@ -0,0 +1,88 @@
+# test_upload.py — run with: python -m pytest -q test_upload.py
+import hashlib
+import io
+import os
+import tempfile
+
+import pytest
+
+import app
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+@pytest.fixture
+def gallery(monkeypatch):
+    """A scratch upload folder and manifest; variant builds are recorded, not run."""
+    folder = tempfile.mkdtemp(prefix="helena-test-")
+    manifest = app.GalleryManifest(folder, os.path.join(tempfile.mkdtemp(prefix="helena-test-"), "manifest.json"))
+    monkeypatch.setitem(app.app.config, "UPLOAD_FOLDER", folder)
+    monkeypatch.setattr(app, "GALLERY", manifest)
+    submitted = []
+    monkeypatch.setattr(app.GALLERY_VARIANTS, "submit", submitted.append)
+    manifest.submitted = submitted
+    return manifest
+
+
+@pytest.fixture
+def client():
+    client = app.app.test_client()
+    with client.session_transaction() as s:
+        s['logged_in'] = True
+    return client
+
+
+def _upload(client, data, filename="photo.png"):
+    return client.post("/upload", data={"image": (io.BytesIO(data), filename)},
+                       content_type="multipart/form-data")
+
+
+def _files(gallery):
+    return sorted(os.listdir(gallery.folder))
+
+
+def test_image_is_stored_under_its_sniffed_type(client, gallery):
+    data = PNG + os.urandom(2048)
+    resp = _upload(client, data, filename="holiday.gif")  # the name's extension is not trusted
+    assert resp.status_code == 302
+    (name,) = _files(gallery)
+    assert name.endswith(".png")
+    assert gallery.get(name)["sha256"] == hashlib.sha256(data).hexdigest()
+    assert gallery.submitted == [name]
+
+
+def test_same_bytes_are_stored_once(client, gallery):
+    data = b'\xff\xd8\xff' + os.urandom(4096)
+    assert _upload(client, data, "a.jpg").status_code == 302
+    assert _upload(client, data, "b.jpg").status_code == 302
+    assert len(_files(gallery)) == 1 and len(gallery.names()) == 1
+
+    assert _upload(client, b'\xff\xd8\xff' + os.urandom(4096), "c.jpg").status_code == 302
+    assert len(_files(gallery)) == 2 and len(gallery.submitted) == 2
+
+
+@pytest.mark.parametrize("data,status", [
+    (b"just some text, not an image at all", 415),  # fails the magic-byte sniff
+    (b"GIF8", 400),                                   # too short to sniff
+])
+def test_rejected_content_leaves_no_files(client, gallery, data, status):
+    assert _upload(client, data, "notes.png").status_code == status
+    assert _files(gallery) == []
+    assert gallery.names() == []
+
+
+@pytest.mark.parametrize("size", [
+    4096,        # over the cap: stopped by UploadSink.write()
+    256 * 1024,  # over the cap plus form overhead: stopped before parsing
+])
+def test_oversized_upload_is_413_and_cleaned_up(client, gallery, monkeypatch, size):
+    monkeypatch.setattr(app, "UPLOAD_MAX_BYTES", 1024)
+    assert _upload(client, PNG + b"\0" * size).status_code == 413
+    assert _files(gallery) == []
+
+
+def test_upload_needs_login_and_a_file(client, gallery):
+    assert _upload(app.app.test_client(), PNG + b"\0" * 64).status_code == 403
+    assert client.post("/upload", data={}, content_type="multipart/form-data").status_code == 400
+    assert _upload(client, PNG + b"\0" * 64, filename="").status_code == 400
+    assert _files(gallery) == []